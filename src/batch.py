@@ -0,0 +1,256 @@
+# ------------------------------------------------------------------------------
+#                        __   _____                  __
+#      ____  ___  ____ _/ /__/ ___/_________  __  __/ /_
+#     / __ \/ _ \/ __ `/ //_/\__ \/ ___/ __ \/ / / / __/
+#    / /_/ /  __/ /_/ / ,<  ___/ / /__/ /_/ / /_/ / /_
+#   / .___/\___/\__,_/_/|_|/____/\___/\____/\__,_/\__/
+#  /_/
+#
+# Copyrigh 2025 GNU AFFERO GENERAL PUBLIC LICENSE
+# Alexander L. Lin, Lana A. Cartailler, Jean-Philippe Cartailler
+# https://github.com/vandydata/peakScout
+#
+# ------------------------------------------------------------------------------
+
+import glob
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from peak2gene import peak2gene
+from process_input import strip_compression_suffix
+from reference import preload_reference, reference_cache_stats
+from write_output import OUTPUT_TYPES
+
+
+def peak2gene_batch(
+    peak_files: list,
+    manifest: str,
+    peak_type: str,
+    num_features: int,
+    ref_dir: str,
+    out_dir: str,
+    output_type: str,
+    species_genome: str = None,
+    option: str = "native_peak_boundaries",
+    boundary: int = None,
+    up_bound: int = None,
+    down_bound: int = None,
+    consensus: bool = False,
+    drop_columns: bool = False,
+    view_window: float = 0.2,
+    engine: str = "batch",
+    defer_urls: bool = False,
+    workers: int = 1,
+    layout: str = "wide",
+) -> dict:
+    """
+    Find the nearest genes for the peaks of many peak files. The gene reference is
+    loaded once into the in-process reference cache and shared by a pool of
+    worker threads, each annotating one peak file at a time with peak2gene. One
+    output is written per peak file, and the number of peaks and the throughput
+    of every file are printed once all files are done.
+
+    Parameters:
+    peak_files (list): Paths or glob patterns of peak files. None if only a manifest is given.
+    manifest (str): Path to a text file listing one peak file per line, optionally
+                    followed by a tab and its output name. Relative paths are taken
+                    relative to the manifest. None if only peak_files are given.
+    peak_type (str): Type of peak caller used to generate the peak files (e.g. MACS2, SEACR, BED6).
+    num_features (int): Number of nearest features to find.
+    ref_dir (str): Directory containing decomposed reference data.
+    out_dir (str): Directory to output files.
+    output_type (str): Output type (csv, xlsx, csv.gz, csv.zst, parquet or arrow file).
+    species_genome (str): Species of the reference genome.
+    option (str): Option for defining start and end positions of peaks.
+    boundary (int): Boundary for artificial peak boundary option. None if other options.
+    up_bound (int): Maximum allowed distance between peak and upstream feature.
+    down_bound (int): Maximum allowed distance between peak and downstream feature.
+    consensus (bool): Whether to use consensus peaks. Default False.
+    drop_columns (bool): Whether to drop unnecessary columns from the original file. Default False.
+    view_window (float): Proportion of the peak region in entire genome browser window. Default 0.2.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'. Default 'batch'.
+    defer_urls (bool): Whether to generate UCSC Genome Browser URLs only when writing output
+                       instead of storing them with each chromosome's results. Default False.
+    workers (int): Number of peak files to annotate in parallel. Default 1.
+    layout (str): Output layout, either 'wide' or 'long' (see peak2gene). Default 'wide'.
+
+    Returns:
+    results (dict): Dictionary mapping output name to a tuple of the peak file, its
+                    number of peaks and the seconds taken, or the exception raised
+                    for peak files that failed.
+
+    Outputs:
+    One CSV file or Excel sheet per peak file containing peak data, the nearest k genes
+    for each peak, and the distance between those genes and the peak.
+    """
+    peak_files = collect_peak_files(peak_files, manifest)
+    if not peak_files:
+        raise ValueError("No peak files to annotate")
+
+    if output_type not in OUTPUT_TYPES:
+        raise ValueError("Invalid output type")
+
+    os.makedirs(out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    num_genes = preload_reference(ref_dir, "gene")
+    print(
+        f"Loaded {num_genes} genes from {ref_dir} in {time.perf_counter() - start:.2f} s"
+    )
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {
+            output_name: pool.submit(
+                annotate_peak_file,
+                peak_file,
+                peak_type,
+                num_features,
+                ref_dir,
+                output_name,
+                out_dir,
+                output_type,
+                species_genome,
+                option,
+                boundary,
+                up_bound,
+                down_bound,
+                consensus,
+                drop_columns,
+                view_window,
+                engine,
+                defer_urls,
+                layout=layout,
+            )
+            for output_name, peak_file in peak_files.items()
+        }
+        results = {}
+        for output_name, future in futures.items():
+            try:
+                results[output_name] = future.result()
+            except Exception as e:
+                results[output_name] = e
+
+    report_batch(peak_files, results, out_dir, output_type)
+    print(
+        f"Annotated {len(peak_files)} peak files in {time.perf_counter() - start:.2f} s"
+    )
+
+    failed = [name for name, result in results.items() if isinstance(result, Exception)]
+    if failed:
+        raise RuntimeError(
+            f"{len(failed)} of {len(peak_files)} peak files could not be annotated"
+        )
+
+    return results
+
+
+def collect_peak_files(peak_files: list, manifest: str) -> dict:
+    """
+    Collect the peak files of a batch and name their outputs. Glob patterns are
+    expanded in sorted order; outputs are named after the peak file without its
+    compression suffix and extension unless the manifest names them.
+
+    Parameters:
+    peak_files (list): Paths or glob patterns of peak files, or None.
+    manifest (str): Path to a manifest of peak files (see peak2gene_batch), or None.
+
+    Returns:
+    peak_files (dict): Dictionary mapping output name to peak file path, in input order.
+
+    Outputs:
+    None
+    """
+    entries = []
+    for pattern in peak_files or []:
+        matches = sorted(glob.glob(pattern))
+        if not matches:
+            raise FileNotFoundError(f"No peak files match {pattern}")
+        entries += [(peak_file, None) for peak_file in matches]
+
+    if manifest is not None:
+        manifest_dir = os.path.dirname(manifest)
+        with open(manifest) as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                fields = line.rstrip("\n").split("\t")
+                peak_file = os.path.join(manifest_dir, fields[0].strip())
+                output_name = fields[1].strip() if len(fields) > 1 else None
+                entries.append((peak_file, output_name or None))
+
+    collected = {}
+    for peak_file, output_name in entries:
+        if output_name is None:
+            output_name = os.path.splitext(
+                os.path.basename(strip_compression_suffix(peak_file))
+            )[0]
+        if output_name in collected:
+            raise ValueError(
+                f"{peak_file} and {collected[output_name]} would both be written to {output_name}"
+            )
+        collected[output_name] = peak_file
+
+    return collected
+
+
+def annotate_peak_file(peak_file: str, *args, **kwargs) -> tuple:
+    """
+    Run peak2gene on one peak file of a batch and time it.
+
+    Parameters:
+    peak_file (str): Path to the peak file.
+    args: The remaining positional arguments of peak2gene, with workers and
+          chunk_size left at their defaults.
+    kwargs: Keyword arguments of peak2gene, such as layout.
+
+    Returns:
+    result (tuple): The peak file, its number of peaks and the seconds taken.
+
+    Outputs:
+    The output file written by peak2gene.
+    """
+    start = time.perf_counter()
+    num_peaks = peak2gene(peak_file, *args, **kwargs)
+    return peak_file, num_peaks, time.perf_counter() - start
+
+
+def report_batch(
+    peak_files: dict, results: dict, out_dir: str, output_type: str
+) -> None:
+    """
+    Print the number of peaks and the throughput of every peak file of a batch,
+    and the hit/miss statistics and memory use of the reference cache they shared.
+
+    Parameters:
+    peak_files (dict): Dictionary mapping output name to peak file path.
+    results (dict): Dictionary mapping output name to the result of annotate_peak_file,
+                    or the exception it raised.
+    out_dir (str): Directory the outputs were written to.
+    output_type (str): Output type (csv, xlsx, csv.gz, csv.zst, parquet or arrow file).
+
+    Returns:
+    None
+
+    Outputs:
+    None
+    """
+    for output_name, peak_file in peak_files.items():
+        result = results[output_name]
+        if isinstance(result, Exception):
+            print(f"{peak_file}: failed: {result}")
+            continue
+
+        _, num_peaks, seconds = result
+        print(
+            f"{peak_file}: {num_peaks} peaks in {seconds:.2f} s "
+            f"({num_peaks / max(seconds, 1e-9):.0f} peaks/s) -> "
+            f"{os.path.join(out_dir, output_name)}.{output_type}"
+        )
+
+    stats = reference_cache_stats()
+    print(
+        f"Reference cache: {stats['hits']} hits, {stats['misses']} misses "
+        f"({stats['stale']} stale), {stats['evictions']} evictions, "
+        f"{stats['bytes'] / 2**20:.1f} of {stats['max_bytes'] / 2**20:.1f} MiB"
+    )
@@ -0,0 +1,167 @@
+# ------------------------------------------------------------------------------
+#                        __   _____                  __
+#      ____  ___  ____ _/ /__/ ___/_________  __  __/ /_
+#     / __ \/ _ \/ __ `/ //_/\__ \/ ___/ __ \/ / / / __/
+#    / /_/ /  __/ /_/ / ,<  ___/ / /__/ /_/ / /_/ / /_
+#   / .___/\___/\__,_/_/|_|/____/\___/\____/\__,_/\__/
+#  /_/
+#
+# Copyrigh 2025 GNU AFFERO GENERAL PUBLIC LICENSE
+# Alexander L. Lin, Lana A. Cartailler, Jean-Philippe Cartailler
+# https://github.com/vandydata/peakScout
+#
+# ------------------------------------------------------------------------------
+
+import polars as pl
+import os
+from process_input import process_peaks, edit_peaks
+
+# Columns of a replicate peak that are collected into the consensus table, with
+# the columns they are read from for each peak file format (first one present).
+REPLICATE_COLUMNS = {
+    "score": (["score", "max_signal"], pl.Float64),
+    "abs_summit": (["abs_summit"], pl.Int64),
+    "pileup": (["pileup"], pl.Float64),
+    "pvalue": (["neg_log10_pvalue", "pvalue"], pl.Float64),
+    "fold_enrichment": (["fold_enrichment", "signal"], pl.Float64),
+    "qvalue": (["neg_log10_qvalue", "qvalue"], pl.Float64),
+    "strand": (["strand"], pl.String),
+}
+
+
+def build_consensus(
+    peak_files: list,
+    peak_type: str,
+    min_support: int = 1,
+    option: str = "native_peak_boundaries",
+    boundary: int = None,
+    columns: list = None,
+) -> pl.LazyFrame:
+    """
+    Build consensus peaks from replicate peak files. The peaks of all replicates
+    are sorted by chromosome and start position and swept once: a peak starting
+    after the furthest end seen so far on its chromosome starts a new consensus
+    peak, otherwise it is merged into the current one (peaks sharing a position
+    overlap, as in check_overlap). Consensus peaks supported by fewer than
+    min_support distinct replicates are dropped. The result has the columns of
+    read_input_MACS2_bed_consensus; the values of the merged peaks are listed
+    comma separated, with '.' where a peak file format has no such value.
+
+    Parameters:
+    peak_files (list): Paths to the replicate peak files.
+    peak_type (str): Type of peak caller used to generate the peak files (e.g. MACS2, SEACR, BED6).
+    min_support (int): Minimum number of replicates with a peak in a consensus peak. Default 1.
+    option (str): Option for defining start and end positions of consensus peaks.
+                  Default 'native_peak_boundaries'.
+    boundary (int): Boundary for artificial peak boundary option. None if other options.
+    columns (list): Columns to keep, or None to keep all columns. Default None.
+
+    Returns:
+    consensus (pl.LazyFrame): Polars LazyFrame containing the consensus peaks.
+
+    Outputs:
+    None
+    """
+    if min_support > len(peak_files):
+        raise ValueError(
+            f"min_support {min_support} is larger than the number of replicates"
+        )
+
+    peaks = pl.concat(
+        [
+            normalize_replicate(
+                process_peaks(
+                    peak_file, peak_type, "native_peak_boundaries", None, False
+                ),
+                os.path.basename(peak_file),
+            ).with_columns(pl.lit(replicate).alias("replicate"))
+            for replicate, peak_file in enumerate(peak_files)
+        ]
+    ).sort(["chr", "start", "end"])
+
+    furthest_end = pl.col("end").cum_max().shift(1).over("chr")
+    peaks = peaks.with_columns(
+        (pl.col("start") > furthest_end).fill_null(True).cum_sum().alias("consensus")
+    )
+
+    def listed(column: str) -> pl.Expr:
+        return pl.col(column).cast(pl.String).fill_null(".").str.join(",")
+
+    consensus = (
+        peaks.group_by("consensus", maintain_order=True)
+        .agg(
+            pl.col("chr").first(),
+            pl.col("start").min(),
+            pl.col("end").max(),
+            listed("start").alias("peak_starts"),
+            listed("end").alias("peak_ends"),
+            listed("name"),
+            listed("score").alias("scores"),
+            listed("length").alias("peak_lengths"),
+            listed("abs_summit").alias("abs_summits"),
+            listed("pileup").alias("pileups"),
+            listed("pvalue").alias("pvalues"),
+            listed("fold_enrichment").alias("fold_enrichments"),
+            listed("qvalue").alias("qvalues"),
+            listed("strand").alias("strands"),
+            pl.col("source_file")
+            .unique(maintain_order=True)
+            .str.join(",")
+            .alias("source_files"),
+            pl.len().alias("num_peaks"),
+            pl.col("score").mean().alias("avg_score"),
+            pl.col("pileup").mean().alias("avg_pileup"),
+            pl.col("pvalue").mean().alias("avg_pvalue"),
+            pl.col("fold_enrichment").mean().alias("avg_fold_enrichment"),
+            pl.col("qvalue").mean().alias("avg_qvalue"),
+            pl.col("replicate").n_unique().alias("support"),
+        )
+        .filter(pl.col("support") >= min_support)
+        .drop(["consensus", "support"])
+    )
+
+    consensus = edit_peaks(consensus, option, boundary)
+    if columns is not None:
+        consensus = consensus.select(columns)
+
+    return consensus
+
+
+def normalize_replicate(peaks: pl.LazyFrame, source_file: str) -> pl.LazyFrame:
+    """
+    Select the columns of a replicate peak file that are collected into the
+    consensus table, under common names and types, so that replicates of any
+    peak file format can be merged.
+
+    Parameters:
+    peaks (pl.LazyFrame): Polars LazyFrame of the peaks of one replicate.
+    source_file (str): Name of the replicate peak file.
+
+    Returns:
+    peaks (pl.LazyFrame): Polars LazyFrame with the chr, start, end, name, length,
+                          source_file and REPLICATE_COLUMNS columns of the peaks.
+
+    Outputs:
+    None
+    """
+    names = peaks.collect_schema().names()
+
+    selected = [
+        pl.col("chr").cast(pl.String),
+        pl.col("start").cast(pl.Int64),
+        pl.col("end").cast(pl.Int64),
+        pl.col("name").cast(pl.String),
+        (pl.col("end") - pl.col("start")).cast(pl.Int64).alias("length"),
+        pl.lit(source_file).alias("source_file"),
+    ]
+    for column, (sources, dtype) in REPLICATE_COLUMNS.items():
+        source = next((source for source in sources if source in names), None)
+        if source is not None:
+            selected.append(pl.col(source).cast(dtype).alias(column))
+        elif column == "abs_summit" and "peak" in names:
+            # narrowPeak files store the summit relative to the peak start
+            selected.append((pl.col("start") + pl.col("peak")).alias(column))
+        else:
+            selected.append(pl.lit(None, dtype).alias(column))
+
+    return peaks.select(selected)
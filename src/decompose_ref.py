@@ -13,119 +13,572 @@
 # ------------------------------------------------------------------------------
 
 import polars as pl
+import pyarrow as pa
+import pyarrow.csv as pcsv
 import os
-
-
-def decompose_gtf(ref_dir: str, gtf_ref: str) -> None:
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from reference import (
+    load_reference,
+    load_manifest,
+    write_manifest,
+    outputs_up_to_date,
+    file_sha256,
+    reference_path,
+    end_order_path,
+    write_reference,
+    gen_reference_stats,
+    write_end_order,
+    gen_end_order,
+    write_name_index,
+    gen_name_index,
+)
+
+# The attribute keys read when annotating peaks; decomposing with only these
+# (attributes ['annotation']) keeps the reference small.
+ANNOTATION_ATTRIBUTES = ["gene_id", "gene_name", "gene_type", "transcript_id"]
+
+GTF_SCHEMA = {
+    "chr": pa.string(),
+    "source": pa.string(),
+    "feature": pa.string(),
+    "start": pa.int64(),
+    "end": pa.int64(),
+    "score": pa.string(),
+    "strand": pa.string(),
+    "frame": pa.string(),
+    "attribute": pa.string(),
+}
+
+
+def decompose_gtf(
+    ref_dir: str,
+    gtf_ref: str,
+    ref_format: str = "arrow",
+    attributes: list = None,
+    block_size: int = 1 << 24,
+    workers: int = 1,
+    features: list = None,
+) -> None:
     """
     Decompose a GTF file into its various features (i.e. gene, CDS, exon, etc.).
     Each feature is further decomposed by chromosome, and the start and end
-    positions of each feature are noted in the chromosomal csv files.
+    positions of each feature are noted in the chromosomal reference files.
+    Features are stored once, sorted by start position, next to the permutation
+    that puts them in end order. Genes are also indexed by gene name.
+
+    The GTF is read in blocks, plain or gzip/bgzip compressed, and only the rows
+    of the chromosome being read are held in memory: the references of a
+    chromosome are written as soon as the next chromosome starts. A chromosome
+    that appears again later in an unsorted GTF is merged into its
+    already written references.
+
+    With several workers, the feature/chromosome partitions are decomposed on
+    a pool of worker processes while the GTF is still being read. Every file is
+    written atomically, and the time taken by each partition is reported.
+
+    The ref_dir keeps a manifest (see load_manifest) of the GTF checksum, the
+    parameters, the checksum of every output and the statistics of every
+    reference (see gen_reference_stats). Feature types whose outputs
+    are up to date for the same GTF and parameters are not decomposed again.
+    When the GTF or the parameters change, the outputs of the feature types
+    that are not decomposed again are removed, so that no reference of the
+    previous GTF is left to be read.
 
     Parameters:
     ref_dir (str): The directory to store the GTF decompositions.
-    gtf_ref (str): The path to the GTF file.
+    gtf_ref (str): The path to the GTF file, optionally gzip or bgzip compressed.
+    ref_format (str): Format of the reference files: 'arrow' (Arrow IPC), 'parquet',
+                      or 'csv' for a plain text export. Default 'arrow'.
+    attributes (list): Attribute keys to keep, or ['annotation'] for ANNOTATION_ATTRIBUTES.
+                       gene_name is always kept. If None, every attribute is kept.
+                       Default None.
+    block_size (int): Number of bytes of the GTF read at a time. Default 16 MiB.
+    workers (int): Number of worker processes. With 1 the partitions are decomposed
+                   in this process. Default 1.
+    features (list): Feature types to decompose (e.g. ['gene', 'exon']). If None,
+                     every feature type in the GTF is decomposed. Default None.
 
     Returns:
     None
 
     Outputs:
-    The function will produce decomposed csv files and their parent directories
-    as follows:
-
-                ref_dir/feature/chr{i}_[start | end].csv
-
-    where species is the species provided in the parameters, feature is the
-    particular feature being decomposed (i.e. gene, CDS, exon, etc), i ranges
-    from 1 to the total number of chromosomes (and can also include non-autosomes
-    such as X and Y and non-nuclear chromosomes such as M), and [start | end] means
-    that particular CSV file will contain the features sorted by either start or
-    end position.
+    The function will produce decomposed reference files and their parent
+    directories as follows:
+
+                ref_dir/feature/chr{i}_start.[arrow | parquet | csv]
+                ref_dir/feature/chr{i}_end_order.npy
+                ref_dir/gene/gene_name_index.[arrow | parquet | csv]
+                ref_dir/manifest.json
+
+    where feature is the particular feature being decomposed (i.e. gene, CDS,
+    exon, etc), and i ranges from 1 to the total number of chromosomes (and can
+    also include non-autosomes such as X and Y and non-nuclear chromosomes such
+    as M). The start file contains the features sorted by start position, and
+    the end_order file holds the int32 row indices of the start file sorted by
+    end position. The gene_name index maps each gene name to the chromosome
+    and row of the gene start file it is stored at.
     """
 
     if not os.path.exists(ref_dir):
         os.makedirs(ref_dir, exist_ok=True)
 
-    col_names = [
-        "chr",
-        "source",
-        "feature",
-        "start",
-        "end",
-        "score",
-        "strand",
-        "frame",
-        "attribute",
+    if attributes == ["annotation"]:
+        attributes = ANNOTATION_ATTRIBUTES
+    if attributes is not None and "gene_name" not in attributes:
+        attributes = list(attributes) + ["gene_name"]
+
+    params = {"ref_format": ref_format, "attributes": attributes}
+    gtf_sha256 = file_sha256(gtf_ref)
+    manifest = load_manifest(ref_dir)
+    previous = manifest.get("features", {})
+    if (
+        manifest.get("gtf", {}).get("sha256") != gtf_sha256
+        or manifest.get("params") != params
+    ):
+        manifest = {
+            "gtf": {"path": os.path.abspath(gtf_ref), "sha256": gtf_sha256},
+            "params": params,
+            "features": {},
+        }
+
+    current = [
+        feature
+        for feature, entry in manifest["features"].items()
+        if outputs_up_to_date(ref_dir, entry["outputs"])
     ]
+    requested = features if features is not None else manifest["gtf"].get("features")
+    if requested is not None and set(requested) <= set(current):
+        print(f"{ref_dir} is up to date")
+        return
+
+    pool = None
+    if workers > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+
+    seen = set()
+    written = set()
+    pending = {}
+    partitions = {}
+    chromosome = None
+    rows = []
+
+    try:
+        for chunk in read_gtf(gtf_ref, block_size):
+            seen.update(chunk.get_column("feature").unique().to_list())
+            chunk = chunk.filter(~pl.col("feature").is_in(current))
+            if features is not None:
+                chunk = chunk.filter(pl.col("feature").is_in(features))
+
+            runs = chunk.with_columns(pl.col("chr").rle_id().alias("run")).partition_by(
+                "run", maintain_order=True, include_key=False
+            )
+            for run in runs:
+                if run.item(0, "chr") != chromosome:
+                    if rows:
+                        decompose_chromosome(
+                            pl.concat(rows),
+                            ref_dir,
+                            ref_format,
+                            attributes,
+                            pool,
+                            written,
+                            pending,
+                            partitions,
+                            2 * workers,
+                        )
+                    chromosome = run.item(0, "chr")
+                    rows = []
+                rows.append(run)
+
+        if rows:
+            decompose_chromosome(
+                pl.concat(rows),
+                ref_dir,
+                ref_format,
+                attributes,
+                pool,
+                written,
+                pending,
+                partitions,
+                2 * workers,
+            )
+
+        while pending:
+            collect_partition(next(iter(pending)), pending, partitions)
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    align_partitions(partitions, ref_dir, ref_format)
+
+    outputs = {}
+    stats = {}
+    for (chromosome, feature), (partition_stats, _, _, files, _) in partitions.items():
+        outputs.setdefault(feature, {}).update(files)
+        stats.setdefault(feature, {})[chromosome] = partition_stats
+
+    gene_names = {
+        chromosome: names
+        for (chromosome, feature), (_, _, names, _, _) in partitions.items()
+        if feature == "gene"
+    }
+    if gene_names:
+        path = write_name_index(
+            gen_name_index(gene_names), ref_dir, "gene", "gene_name", ref_format
+        )
+        outputs["gene"][os.path.relpath(path, ref_dir)] = file_sha256(path)
+
+    for feature in features if features is not None else []:
+        if feature not in seen:
+            print(f"Warning: no {feature} features in {gtf_ref}")
+
+    for feature, files in outputs.items():
+        # Outputs of the previous build that were not written again are stale.
+        remove_outputs(
+            ref_dir, set(previous.get(feature, {}).get("outputs", {})) - set(files)
+        )
+        manifest["features"][feature] = {
+            "outputs": dict(sorted(files.items())),
+            "stats": dict(sorted(stats[feature].items())),
+        }
+
+    for feature, entry in previous.items():
+        if feature not in manifest["features"]:
+            # Built from another GTF or with other parameters and not rebuilt.
+            remove_outputs(ref_dir, entry["outputs"])
+
+    manifest["gtf"]["features"] = sorted(seen)
+    write_manifest(manifest, ref_dir)
+
+
+def remove_outputs(ref_dir: str, names) -> None:
+    """
+    Remove outputs of a previous build, and the feature directories they leave empty.
+
+    Parameters:
+    ref_dir (str): The directory of the GTF decompositions.
+    names (iterable): Paths of the outputs, relative to ref_dir.
+
+    Returns:
+    None
+
+    Outputs:
+    None
+    """
+    for name in names:
+        path = os.path.join(ref_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+        directory = os.path.dirname(path)
+        if (
+            os.path.normpath(directory) != os.path.normpath(ref_dir)
+            and os.path.isdir(directory)
+            and not os.listdir(directory)
+        ):
+            os.rmdir(directory)
+
+
+def read_gtf(gtf_ref: str, block_size: int = 1 << 24):
+    """
+    Read a GTF file in blocks. gzip and bgzip compressed files are recognized
+    by their magic bytes and decompressed while reading. Comment and header
+    lines (starting with '#') are skipped.
+
+    Parameters:
+    gtf_ref (str): The path to the GTF file.
+    block_size (int): Number of bytes read at a time. Default 16 MiB.
+
+    Returns:
+    chunks (generator): Generator of Polars DataFrames with the nine GTF columns.
 
-    full_df = pl.read_csv(
-        gtf_ref,
-        has_header=False,
-        separator="\t",
-        skip_rows=5,
-        new_columns=col_names,
-        schema_overrides={"chr": pl.String},
+    Outputs:
+    None
+    """
+    with open(gtf_ref, "rb") as f:
+        compression = "gzip" if f.read(2) == b"\x1f\x8b" else None
+
+    reader = pcsv.open_csv(
+        pa.input_stream(gtf_ref, compression=compression),
+        read_options=pcsv.ReadOptions(
+            column_names=list(GTF_SCHEMA), block_size=block_size
+        ),
+        parse_options=pcsv.ParseOptions(
+            delimiter="\t",
+            quote_char=False,
+            invalid_row_handler=lambda row: (
+                "skip" if row.text.startswith("#") else "error"
+            ),
+        ),
+        convert_options=pcsv.ConvertOptions(column_types=GTF_SCHEMA),
     )
 
-    for name, group in full_df.group_by(["feature"]):
-        group = split_jumble(group)
+    for batch in reader:
+        chunk = pl.from_arrow(batch)
+        yield chunk.filter(~pl.col("chr").str.starts_with("#"))
+
+
+def decompose_chromosome(
+    rows: pl.DataFrame,
+    ref_dir: str,
+    ref_format: str,
+    attributes: list,
+    pool: ProcessPoolExecutor,
+    written: set,
+    pending: dict,
+    partitions: dict,
+    max_pending: int = 2,
+) -> None:
+    """
+    Decompose the GTF rows of one chromosome by feature, either in this process
+    or by submitting each feature partition to the worker pool. At most
+    max_pending partitions are left pending, so that the rows waiting to be
+    decomposed stay bounded.
 
-        decomposed_dfs_start = {
-            (chr[0], name[0]): chr_group.sort("start").unique(subset="start")
-            for chr, chr_group in group.group_by(["chr"])
-        }
-        save_csvs(decomposed_dfs_start, "start", ref_dir)
+    Parameters:
+    rows (pl.DataFrame): Polars DataFrame of GTF rows on a single chromosome.
+    ref_dir (str): The directory to store the GTF decompositions.
+    ref_format (str): Format of the reference files: 'arrow', 'parquet' or 'csv'.
+    attributes (list): Attribute keys to keep, or None to keep every attribute.
+    pool (ProcessPoolExecutor): Worker pool, or None to decompose in this process.
+    written (set): (chromosome, feature) pairs already decomposed or submitted.
+                   Rows of a pair in it are merged into the written reference.
+    pending (dict): Dictionary mapping (chromosome, feature) to the future of its
+                    submitted partition, updated in place.
+    partitions (dict): Dictionary mapping (chromosome, feature) to the result of its
+                       decompose_task, updated in place.
+    max_pending (int): Maximum number of submitted partitions left pending. Default 2.
 
-        decomposed_dfs_end = {
-            chr_name: chr_group.sort("end")
-            for chr_name, chr_group in decomposed_dfs_start.items()
-        }
-        save_csvs(decomposed_dfs_end, "end", ref_dir)
+    Returns:
+    None
+
+    Outputs:
+    The reference files of each feature on the chromosome (see decompose_partition).
+    """
+    chromosome = rows.item(0, "chr")
+
+    for (feature,), group in rows.group_by("feature", maintain_order=True):
+        key = (chromosome, feature)
+        if key in pending:
+            # The merge must read the finished reference of the earlier rows.
+            collect_partition(key, pending, partitions)
+
+        args = (group, ref_dir, feature, chromosome, ref_format, attributes)
+        args += (key in written,)
+        written.add(key)
+        # Reserve the slot so that partitions stay in GTF order, whichever
+        # order the workers finish in.
+        partitions.setdefault(key, None)
+
+        if pool is None:
+            report_partition(key, decompose_task(*args), partitions)
+        else:
+            pending[key] = pool.submit(decompose_task, *args)
+            while len(pending) > max_pending:
+                collect_partition(next(iter(pending)), pending, partitions)
+
+
+def decompose_task(
+    group: pl.DataFrame,
+    ref_dir: str,
+    feature: str,
+    chromosome: str,
+    ref_format: str,
+    attributes: list,
+    merge: bool,
+) -> tuple:
+    """
+    Decompose the GTF rows of one feature type on one chromosome. This is the
+    unit of work run on the worker pool.
 
+    Parameters:
+    group (pl.DataFrame): Polars DataFrame of GTF rows of one feature on one chromosome.
+    ref_dir (str): The directory to store the GTF decompositions.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    ref_format (str): Format of the reference files: 'arrow', 'parquet' or 'csv'.
+    attributes (list): Attribute keys to keep, or None to keep every attribute.
+    merge (bool): Whether to merge the rows into the already written reference.
+
+    Returns:
+    result (tuple): The statistics of the written reference (see gen_reference_stats),
+                    the seconds taken, the gene_name column of the reference for
+                    genes (None otherwise), a dictionary mapping each written
+                    file, relative to ref_dir, to its SHA-256 checksum, and the
+                    list of columns of the reference.
 
-def save_csvs(df: pl.DataFrame, col: str, out_dir: str) -> None:
+    Outputs:
+    The reference files of the partition (see decompose_partition).
     """
-    Save a given Polars DataFrame as a CSV file.
+    start_time = time.perf_counter()
+
+    df = split_jumble(group, attributes)
+    if merge:
+        df = pl.concat(
+            [
+                load_reference(
+                    ref_dir, feature, chromosome, "start", use_cache=False
+                ).with_columns(pl.col(pl.Categorical).cast(pl.String)),
+                df,
+            ],
+            how="diagonal_relaxed",
+        )
+
+    df = decompose_partition(df, ref_dir, feature, chromosome, ref_format)
+    names = df.select("gene_name") if feature == "gene" else None
+    files = {
+        os.path.relpath(path, ref_dir): file_sha256(path)
+        for path in [
+            reference_path(ref_dir, feature, chromosome, "start", ref_format),
+            end_order_path(ref_dir, feature, chromosome),
+        ]
+    }
+
+    return (
+        gen_reference_stats(df),
+        time.perf_counter() - start_time,
+        names,
+        files,
+        df.columns,
+    )
+
+
+def collect_partition(key: tuple, pending: dict, partitions: dict) -> None:
+    """
+    Wait for a submitted partition to finish and report it.
 
     Parameters:
-    df (pl.DataFrame): The Polars DataFrame to save as a CSV file.
-    col (str): The column of the GTF that this DataFrame is sorted by.
-               This is either 'start' or 'end.'
-    out_dir (str): The output directory of decomposed csvs.
+    key (tuple): (chromosome, feature) of the partition.
+    pending (dict): Dictionary mapping (chromosome, feature) to the future of its
+                    submitted partition. The partition is removed from it.
+    partitions (dict): Dictionary mapping (chromosome, feature) to the result of its
+                       decompose_task, updated in place.
 
     Returns:
     None
 
     Outputs:
-    The function will save the Polars DataFrame as a CSV at location:
+    None
+    """
+    report_partition(key, pending.pop(key).result(), partitions)
+
 
-                out_dir/feature/chr{i}_[start | end].csv
+def report_partition(key: tuple, result: tuple, partitions: dict) -> None:
+    """
+    Print the size and timing of a decomposed partition and keep its result.
+
+    Parameters:
+    key (tuple): (chromosome, feature) of the partition.
+    result (tuple): The value returned by decompose_task.
+    partitions (dict): Dictionary mapping (chromosome, feature) to the result of its
+                       decompose_task, updated in place.
+
+    Returns:
+    None
 
-    where reference is the specified reference directory in ref_dir, species
-    is the species given in the parameters, i ranges from i to the number of chromosomes
-    (and can include non-autosomes such as X, Y, and non-nuclear chromosomes such as M), and
-    start or end indicates that this CSV contains the features sorted by either start or end
-    position, respectively.
+    Outputs:
+    Prints the chromosome, feature, number of features and seconds taken.
     """
+    chromosome, feature = key
+    stats, seconds = result[:2]
+    print(f"{chromosome} {feature}: {stats['count']} features in {seconds:.2f} s")
+
+    partitions[key] = result
+
 
-    for name, group in df.items():
-        chr = name[0]
-        type_name = name[1]
-        if not os.path.exists(os.path.join(out_dir, type_name)):
-            os.mkdir(os.path.join(out_dir, type_name))
+def align_partitions(partitions: dict, ref_dir: str, ref_format: str) -> None:
+    """
+    Give the references of a feature type the same columns on every chromosome.
+    The attribute keys of a feature are only all known once every chromosome
+    has been decomposed, so a reference missing keys found on other chromosomes
+    is rewritten with those columns null, and the columns of every reference
+    are put in the order their keys first appear in the GTF.
 
-        group.write_csv(os.path.join(out_dir, type_name, chr + "_" + col + ".csv"))
-        print(name)
+    Parameters:
+    partitions (dict): Dictionary mapping (chromosome, feature) to the result of its
+                       decompose_task, in GTF order. The checksums of rewritten
+                       files are updated in place.
+    ref_dir (str): The directory to store the GTF decompositions.
+    ref_format (str): Format of the reference files: 'arrow', 'parquet' or 'csv'.
 
+    Returns:
+    None
 
-def split_jumble(df: pl.DataFrame) -> pl.DataFrame:
+    Outputs:
+    The rewritten reference files at ref_dir/feature/chromosome_start.ref_format.
+    """
+    schemas = {}
+    for (_, feature), (_, _, _, _, columns) in partitions.items():
+        schema = schemas.setdefault(feature, [])
+        schema += [column for column in columns if column not in schema]
+
+    for (chromosome, feature), (_, _, _, files, columns) in partitions.items():
+        schema = schemas[feature]
+        if columns == schema:
+            continue
+
+        df = load_reference(ref_dir, feature, chromosome, "start", use_cache=False)
+        df = df.with_columns(
+            pl.lit(None, pl.String).alias(column)
+            for column in schema
+            if column not in columns
+        ).select(schema)
+        path = write_reference(df, ref_dir, feature, chromosome, "start", ref_format)
+        files[os.path.relpath(path, ref_dir)] = file_sha256(path)
+
+
+def decompose_partition(
+    df: pl.DataFrame,
+    ref_dir: str,
+    feature: str,
+    chromosome: str,
+    ref_format: str = "arrow",
+) -> pl.DataFrame:
+    """
+    Sort the features of one type on one chromosome by start position, keep the
+    first feature at each start position, and write the reference files.
+
+    Parameters:
+    df (pl.DataFrame): Polars DataFrame of features with their attributes split.
+    ref_dir (str): The directory to store the GTF decompositions.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    ref_format (str): Format of the reference files: 'arrow', 'parquet' or 'csv'. Default 'arrow'.
+
+    Returns:
+    df (pl.DataFrame): The Polars DataFrame as written, sorted by start position.
+
+    Outputs:
+    The reference at ref_dir/feature/chromosome_start.ref_format and its end
+    order permutation at ref_dir/feature/chromosome_end_order.npy.
+    """
+    df = df.sort("start", maintain_order=True).unique(
+        subset="start", keep="first", maintain_order=True
+    )
+
+    os.makedirs(os.path.join(ref_dir, feature), exist_ok=True)
+    write_reference(df, ref_dir, feature, chromosome, "start", ref_format)
+    write_end_order(gen_end_order(df), ref_dir, feature, chromosome)
+
+    return df
+
+
+def split_jumble(df: pl.DataFrame, keys: list = None) -> pl.DataFrame:
     """
     Splits the attribute column of the GTF and inserts them into the given Polars
     DataFrame as additional columns. After inserting all columns, the attribute
-    column is removed.
+    column is removed. The attributes are split into key/value pairs with columnar
+    string expressions and pivoted into columns; a key that appears more than once
+    in a row keeps its last value.
 
     Parameters:
     df (pl.DataFrame): The Polars DataFrame whose attribute column needs to be split.
+    keys (list): Attribute keys to extract (e.g. ANNOTATION_ATTRIBUTES). If None, every
+                 key found in the attribute column is extracted, in order of first
+                 appearance. Keys missing from every row are not added. Default None.
 
     Returns:
     df (pl.DataFrame): The Polars DataFrame where each element in the original attribute
@@ -135,29 +588,35 @@ def split_jumble(df: pl.DataFrame) -> pl.DataFrame:
     None
     """
 
-    jumble_data = df.select("attribute")
-
-    unique_keys = set()
-
-    for row in jumble_data.to_numpy():
-        keys = [pair.split(" ")[0] for pair in row[0].split("; ")]
-        unique_keys.update(keys)
-
-    cols_to_add = {key: [] for key in unique_keys}
-    for row in jumble_data.iter_rows(named=True):
-        key_value = {
-            pair.split(" ")[0]: pair.split(" ")[1].replace('"', "").replace(";", "")
-            for pair in row["attribute"].split("; ")
-        }
-        for key in unique_keys:
-            try:
-                cols_to_add[key].append(key_value[key])
-            except:
-                cols_to_add[key].append(None)
-
-    for name, group in cols_to_add.items():
-        df.insert_column(-1, pl.Series(name, group))
-
-    df.drop_in_place("attribute")
+    pairs = (
+        df.select(
+            pl.col("attribute").str.strip_chars_end("; ").str.split("; ").alias("pair")
+        )
+        .with_row_index("row")
+        .explode("pair")
+        .select(
+            "row",
+            pl.col("pair")
+            .str.splitn(" ", 2)
+            .struct.rename_fields(["key", "value"])
+            .alias("pair"),
+        )
+        .unnest("pair")
+        .drop_nulls("key")
+    )
+    if keys is not None:
+        pairs = pairs.filter(pl.col("key").is_in(keys))
 
-    return df
+    attributes = pairs.with_columns(pl.col("value").str.replace_all(r'[";]', "")).pivot(
+        on="key", index="row", values="value", aggregate_function="last"
+    )
+    if keys is not None:
+        attributes = attributes.select(
+            ["row"] + [key for key in keys if key in attributes.columns]
+        )
+
+    return (
+        df.with_row_index("row")
+        .join(attributes, on="row", how="left")
+        .drop(["row", "attribute"])
+    )
@@ -12,11 +12,16 @@
 #
 # ------------------------------------------------------------------------------
 
-import pandas as pd
 import polars as pl
-from process_features import get_nearest_features, decompose_features
+from process_features import (
+    get_nearest_features,
+    decompose_features,
+    chromosome_order,
+    sort_chromosome,
+    iter_chromosomes,
+)
 from process_input import process_peaks, process_genes
-from write_output import write_to_csv, write_to_excel
+from write_output import write_output_stream
 
 
 def gene2peak(
@@ -31,6 +36,9 @@ def gene2peak(
     option: str = "native_peak_boundaries",
     boundary: int = None,
     consensus: bool = False,
+    engine: str = "batch",
+    workers: int = 1,
+    layout: str = "wide",
 ) -> None:
     """
     Find the nearest peaks for a given list of genes.
@@ -43,10 +51,15 @@ def gene2peak(
     ref_dir (str): Directory containing decomposed reference data.
     output_name (str): Name for output file.
     out_dir (str): Directory to output file.
-    output_type (str): Output type (csv file or xlsx file).
+    output_type (str): Output type (csv, xlsx, csv.gz, csv.zst, parquet or arrow file).
     option (str): Option for defining start and end positions of peaks.
     boundary (int): Boundary for artificial peak boundary option. None if other options.
     consensus (bool): Whether to use consensus peaks.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'. Default 'batch'.
+    workers (int): Number of worker processes to annotate chromosomes with. Default 1.
+    layout (str): Output layout: 'wide' for one row per gene with closest_name_<i>
+                  columns, or 'long' for one row per gene and nearest peak, with its
+                  rank and integer distance. Default 'wide'.
 
     Returns:
     None
@@ -56,27 +69,41 @@ def gene2peak(
     between those peaks and the gene.
     """
 
-    peaks = process_peaks(peak_file, peak_type, option, boundary, consensus)
+    # Only the peak name and position are reported, so no other column is read.
+    peaks = process_peaks(
+        peak_file,
+        peak_type,
+        option,
+        boundary,
+        consensus,
+        columns=["name", "chr", "start", "end"],
+    )
     genes = process_genes(gene_file, ref_dir)
 
     decomposed_peaks = decompose_features(peaks)
     decomposed_genes = decompose_features(genes)
 
-    output = find_nearest(decomposed_peaks, decomposed_genes, num_features)
+    outputs = iter_nearest(
+        decomposed_peaks, decomposed_genes, num_features, engine, workers, layout
+    )
 
-    if output_type == "xlsx":
-        write_to_excel(output, output_name, out_dir)
-    elif output_type == "csv":
-        write_to_csv(output, output_name, out_dir)
-    else:
-        raise ValueError("Invalid output type")
+    write_output_stream(outputs, output_name, out_dir, output_type, layout=layout)
 
 
-def find_nearest(
-    decomposed_peaks: dict, decomposed_genes: dict, num_features: int
-) -> pd.DataFrame:
+def iter_nearest(
+    decomposed_peaks: dict,
+    decomposed_genes: dict,
+    num_features: int,
+    engine: str = "batch",
+    workers: int = 1,
+    layout: str = "wide",
+):
     """
-    Find the nearest peaks for a given list of genes. Place these in a Pandas DataFrame.
+    Find the nearest peaks for a given list of genes, one chromosome at a time.
+    With several workers the chromosomes with the most peaks are started first
+    (see iter_chromosomes). The results of each chromosome are yielded in output
+    order, sorted by gene name, as soon as they are available. Peaks that could not
+    be found are null.
 
     Parameters:
     decomposed_peaks (dict): Dictionary containing keys with chromosome number
@@ -84,43 +111,81 @@ def find_nearest(
     decomposed_genes (dict): Dictionary containing keys with chromosome number
                              mapped to Polars DataFrames with genes on that chromosome.
     num_features (int): Number of nearest features to find.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'.
+    workers (int): Number of worker processes to annotate chromosomes with.
+    layout (str): Output layout, either 'wide' or 'long'.
 
     Returns:
-    output (pd.DataFrame): Pandas DataFrame containing gene data, the nearest k peaks for each gene,
-    and the distance between those peaks and the gene.
+    outputs (generator): Generator of Polars DataFrames containing gene data, the nearest k
+    peaks for each gene, and the distance between those peaks and the gene, per chromosome.
 
     Outputs:
     None
     """
 
-    output = pl.DataFrame()
-
-    for key in decomposed_genes.keys():
-        if key in decomposed_peaks.keys():
-            starts = decomposed_peaks[key].select(["name", "start", "end"])
-            ends = decomposed_peaks[key].select(["name", "end"])
-        else:
-            starts = pl.DataFrame({}, schema=["name", "start", "end"])
-            ends = pl.DataFrame({}, schema=["name", "end"])
-        output = pl.concat(
-            [
-                output,
-                get_nearest_features(
-                    decomposed_genes[key],
-                    "name",
-                    starts,
-                    ends,
-                    None,
-                    None,
-                    num_features,
-                    True,
-                    None,
-                    0.2,
-                ),
-            ]
+    tasks = {
+        key: (
+            decomposed_genes[key],
+            decomposed_peaks.get(key),
+            num_features,
+            engine,
+            layout,
         )
+        for key in chromosome_order(decomposed_genes)
+    }
+    sizes = {
+        key: 0 if key not in decomposed_peaks else decomposed_peaks[key].height
+        for key in decomposed_genes
+    }
+    for _, output in iter_chromosomes(annotate_chromosome, tasks, sizes, workers):
+        yield sort_chromosome(output, "name")
+
+
+def annotate_chromosome(
+    genes: pl.DataFrame,
+    peaks: pl.DataFrame,
+    num_features: int,
+    engine: str = "batch",
+    layout: str = "wide",
+) -> pl.DataFrame:
+    """
+    Find the nearest peaks for the genes on one chromosome.
+
+    Parameters:
+    genes (pl.DataFrame): Polars DataFrame with genes on that chromosome.
+    peaks (pl.DataFrame): Polars DataFrame with peaks on that chromosome, sorted by start.
+                          None if there are no peaks on that chromosome.
+    num_features (int): Number of nearest features to find.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'.
+    layout (str): Output layout, either 'wide' or 'long'. Default 'wide'.
 
-    output = output.to_pandas()
-    output = output.sort_values(by=["chr", "name"])
+    Returns:
+    output (pl.DataFrame): Polars DataFrame containing gene data and the nearest k peaks
+    for each gene.
+
+    Outputs:
+    None
+    """
+    if peaks is not None:
+        starts = peaks.select(["name", "start", "end"])
+    else:
+        starts = pl.DataFrame(
+            schema={"name": pl.String, "start": pl.Int64, "end": pl.Int64}
+        )
 
-    return output
+    return get_nearest_features(
+        genes,
+        "name",
+        starts,
+        None,
+        None,
+        None,
+        num_features,
+        True,
+        None,
+        0.2,
+        engine,
+        None,
+        None,
+        layout,
+    )
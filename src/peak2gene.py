@@ -12,12 +12,26 @@
 #
 # ------------------------------------------------------------------------------
 
-import pandas as pd
 import polars as pl
-import os
-from process_features import get_nearest_features, decompose_features
-from process_input import process_peaks
-from write_output import write_to_csv, write_to_excel
+from concurrent.futures import ProcessPoolExecutor
+from process_features import (
+    get_nearest_features,
+    decompose_features,
+    add_ucsc_browser_urls,
+    chromosome_order,
+    sort_chromosome,
+    iter_chromosomes,
+    gen_process_pool,
+)
+from process_input import process_peaks, iter_peaks
+from consensus import build_consensus
+from reference import (
+    load_reference,
+    load_end_order,
+    load_reference_stats,
+    load_interval_index,
+)
+from write_output import write_output_stream, CSV_COMPRESSION
 
 
 def peak2gene(
@@ -36,10 +50,25 @@ def peak2gene(
     consensus: bool = False,
     drop_columns: bool = False,
     view_window: float = 0.2,
-) -> None:
+    engine: str = "batch",
+    defer_urls: bool = False,
+    workers: int = 1,
+    chunk_size: int = None,
+    replicates: list = None,
+    min_support: int = 1,
+    layout: str = "wide",
+) -> int:
     """
     Find the nearest genes for a given list of peaks.
 
+    With chunk_size, the peak file is streamed: chunk_size peaks are read,
+    annotated against the reference (which stays loaded between chunks) and
+    appended to the CSV output before the next chunk is read, so memory use
+    does not grow with the size of the peak file. Peaks should be sorted by
+    chromosome: chromosomes are then written in the order of the input, whatever
+    the chunk size, while without chunk_size they are written in the order of
+    their names.
+
     Parameters:
     peak_file (str): Path to the peak file.
     peak_type (str): Type of peak caller used to generate peak file (e.g. MACS2, SEACR, BED6).
@@ -47,7 +76,7 @@ def peak2gene(
     ref_dir (str): Directory containing decomposed reference data.
     output_name (str): Name for output file.
     out_dir (str): Directory to output file.
-    output_type (str): Output type (csv file or xlsx file).
+    output_type (str): Output type (csv, xlsx, csv.gz, csv.zst, parquet or arrow file).
     species_genome (str): Species of the reference genome.
     option (str): Option for defining start and end positions of peaks.
     boundary (int): Boundary for artificial peak boundary option. None if other options.
@@ -56,18 +85,84 @@ def peak2gene(
     consensus (bool): Whether to use consensus peaks. Default False.
     drop_columns (bool): Whether to drop unnecessary columns from the original file. Default False.
     view_window (float): Proportion of the peak region in entire genome browser window. Default 0.2.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'. Default 'batch'.
+    defer_urls (bool): Whether to generate UCSC Genome Browser URLs only when writing output
+                       instead of storing them with each chromosome's results. Default False.
+    workers (int): Number of worker processes to annotate chromosomes with. Default 1.
+    chunk_size (int): Number of peaks to read and annotate at a time, or None to
+                      read the whole peak file at once. Only CSV output can be
+                      written in chunks. Default None.
+    replicates (list): Paths to replicate peak files to build consensus peaks from
+                       (see build_consensus) instead of reading peak_file. Default None.
+    min_support (int): Minimum number of replicates with a peak in a consensus peak.
+                       Default 1.
+    layout (str): Output layout: 'wide' for one row per peak with closest_gene_name_<i>
+                  columns, or 'long' for one row per peak and nearest gene, with its
+                  rank and integer distance. Default 'wide'.
 
     Returns:
-    None
+    num_peaks (int): Number of peaks read from the peak file.
 
     Outputs:
     Excel sheet containing peak data, the nearest k genes for each peak, and the distance
     between those genes and the peak.
     """
 
-    peaks = process_peaks(peak_file, peak_type, option, boundary, consensus)
+    columns = ["name", "chr", "start", "end"] if drop_columns else None
+
+    if chunk_size is not None:
+        if replicates is not None:
+            raise ValueError("Consensus peaks cannot be annotated in chunks")
+        if output_type not in CSV_COMPRESSION:
+            raise ValueError(
+                "Invalid output type for chunked peak2gene: use csv, csv.gz or csv.zst"
+            )
+
+        append = False
+        num_peaks = 0
+        # The workers are kept for every chunk, with the references they cached.
+        pool = gen_process_pool(workers) if workers > 1 else None
+        try:
+            for peaks in iter_peaks(
+                peak_file, peak_type, option, boundary, consensus, chunk_size, columns
+            ):
+                decomposed_peaks = decompose_features(peaks)
+                num_peaks += sum(map(len, decomposed_peaks.values()))
+                outputs = iter_nearest(
+                    decomposed_peaks,
+                    species_genome,
+                    num_features,
+                    ref_dir,
+                    up_bound,
+                    down_bound,
+                    drop_columns,
+                    view_window,
+                    engine,
+                    defer_urls,
+                    workers,
+                    layout,
+                    input_order=True,
+                    pool=pool,
+                )
+                num_rows = write_output_stream(
+                    outputs, output_name, out_dir, output_type, append, layout
+                )
+                append = append or num_rows > 0
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+        return num_peaks
+
+    if replicates is not None:
+        peaks = build_consensus(
+            replicates, peak_type, min_support, option, boundary, columns
+        )
+    else:
+        peaks = process_peaks(
+            peak_file, peak_type, option, boundary, consensus, columns=columns
+        )
     decomposed_peaks = decompose_features(peaks)
-    output = find_nearest(
+    outputs = iter_nearest(
         decomposed_peaks,
         species_genome,
         num_features,
@@ -76,16 +171,17 @@ def peak2gene(
         down_bound,
         drop_columns,
         view_window,
+        engine,
+        defer_urls,
+        workers,
+        layout,
     )
-    if output_type == "xlsx":
-        write_to_excel(output, output_name, out_dir)
-    elif output_type == "csv":
-        write_to_csv(output, output_name, out_dir)
-    else:
-        raise ValueError("Invalid output type")
+    write_output_stream(outputs, output_name, out_dir, output_type, layout=layout)
+
+    return sum(map(len, decomposed_peaks.values()))
 
 
-def find_nearest(
+def iter_nearest(
     decomposed_peaks: dict,
     species_genome: str,
     num_features: int,
@@ -94,9 +190,20 @@ def find_nearest(
     down_bound: int,
     drop_columns: bool,
     view_window: float,
-) -> pd.DataFrame:
+    engine: str = "batch",
+    defer_urls: bool = False,
+    workers: int = 1,
+    layout: str = "wide",
+    input_order: bool = False,
+    pool: ProcessPoolExecutor = None,
+):
     """
-    Find the nearest genes for a given list of peaks. Place these in a Pandas DataFrame.
+    Find the nearest genes for a given list of peaks, one chromosome at a time.
+    Chromosomes are output in the order of their names, or with input_order in
+    the order of decomposed_peaks. With several workers the chromosomes with the most peaks are started first
+    (see iter_chromosomes). The results of each chromosome are yielded in output
+    order, sorted by start position, as soon as they are available. Features that could
+    not be found are null.
 
     Parameters:
     decomposed_peaks (dict): Dictionary containing keys with chromosome number
@@ -108,44 +215,129 @@ def find_nearest(
     down_bound (int): Maximum allowed distance between peak and downstream feature.
     drop_columns (bool): Whether to drop unnecessary columns from the original file.
     view_window (float): Proportion of the peak region in entire genome browser window.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'.
+    defer_urls (bool): Whether to generate UCSC Genome Browser URLs only for the final output.
+    workers (int): Number of worker processes to annotate chromosomes with.
+    layout (str): Output layout, either 'wide' or 'long'.
+    input_order (bool): Whether to output the chromosomes in the order of decomposed_peaks,
+                        which is the order of the input for peaks sorted by chromosome.
+                        Default False.
+    pool (ProcessPoolExecutor): Pool of worker processes kept across calls (see
+                                gen_process_pool), or None to start one for this
+                                call. Default None.
 
     Returns:
-    output (pd.DataFrame): Pandas DataFrame containing peak data, the nearest k genes for each peak,
-    and the distance between those genes and the peak.
+    outputs (generator): Generator of Polars DataFrames containing peak data, the nearest k
+    genes for each peak, and the distance between those genes and the peak, per chromosome.
 
     Outputs:
     None
     """
-    output = pl.DataFrame()
-    for key in decomposed_peaks.keys():
-        try:
-            starts = pl.read_csv(os.path.join(ref_dir, "gene", key) + "_start.csv")
-            ends = pl.read_csv(os.path.join(ref_dir, "gene", key) + "_end.csv")
-            output = pl.concat(
-                [
-                    output,
-                    get_nearest_features(
-                        decomposed_peaks[key],
-                        "gene_name",
-                        starts,
-                        ends,
-                        up_bound,
-                        down_bound,
-                        num_features,
-                        drop_columns,
-                        species_genome,
-                        view_window,
-                    ),
-                ]
-            )
-        except Exception as e:
-            print(e)
-            print(
-                f"Warning: could not find feature information for chromosome {key}. \
-                  Results for these peaks are not included in the output."
-            )
+    stats = load_reference_stats(ref_dir, "gene")
+    order = (
+        list(decomposed_peaks) if input_order else chromosome_order(decomposed_peaks)
+    )
+    tasks = {
+        key: (
+            key,
+            decomposed_peaks[key],
+            ref_dir,
+            num_features,
+            up_bound,
+            down_bound,
+            drop_columns,
+            None if defer_urls else species_genome,
+            view_window,
+            engine,
+            stats,
+            layout,
+        )
+        for key in order
+    }
+    sizes = {key: peaks.height for key, peaks in decomposed_peaks.items()}
+    for _, output in iter_chromosomes(annotate_chromosome, tasks, sizes, workers, pool):
+        if output is None:
+            continue
+
+        output = sort_chromosome(output, "start")
+        if defer_urls:
+            output = add_ucsc_browser_urls(output, species_genome, view_window)
+
+        yield output
+
+
+def annotate_chromosome(
+    key: str,
+    peaks: pl.DataFrame,
+    ref_dir: str,
+    num_features: int,
+    up_bound: int,
+    down_bound: int,
+    drop_columns: bool,
+    species_genome: str,
+    view_window: float,
+    engine: str = "batch",
+    stats: dict = None,
+    layout: str = "wide",
+) -> pl.DataFrame:
+    """
+    Find the nearest genes for the peaks on one chromosome. The reference for the
+    chromosome is loaded (memory-mapped for binary references) from ref_dir by
+    whichever process runs this function. With the reference statistics from
+    the manifest, chromosomes without genes are skipped without touching the
+    reference files, and the overlap search is bounded by the longest gene. The
+    interval index of the genes is cached with the reference (see load_interval_index).
+
+    Parameters:
+    key (str): Chromosome name (e.g. chr1).
+    peaks (pl.DataFrame): Polars DataFrame with peaks on that chromosome.
+    ref_dir (str): Directory containing decomposed reference data.
+    num_features (int): Number of nearest features to find.
+    up_bound (int): Maximum allowed distance between peak and upstream feature.
+    down_bound (int): Maximum allowed distance between peak and downstream feature.
+    drop_columns (bool): Whether to drop unnecessary columns from the original file.
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
+    engine (str): Nearest feature engine, either 'batch' or 'legacy'.
+    stats (dict): Dictionary mapping chromosome to its gene reference statistics
+                  (see load_reference_stats), or None if unknown. Default None.
+    layout (str): Output layout, either 'wide' or 'long'. Default 'wide'.
 
-    output = output.to_pandas()
-    output = output.sort_values(by=["chr", "start"])
+    Returns:
+    output (pl.DataFrame): Polars DataFrame containing peak data and the nearest k genes
+    for each peak, or None if there is no feature information for the chromosome.
+
+    Outputs:
+    None
+    """
+    try:
+        if stats is not None and not stats.get(key, {}).get("count"):
+            raise FileNotFoundError(f"No gene reference for {key} in {ref_dir}")
 
-    return output
+        starts = load_reference(ref_dir, "gene", key, "start")
+        end_order = load_end_order(ref_dir, "gene", key)
+        index = load_interval_index(ref_dir, "gene", key) if engine == "batch" else None
+        return get_nearest_features(
+            peaks,
+            "gene_name",
+            starts,
+            None,
+            up_bound,
+            down_bound,
+            num_features,
+            drop_columns,
+            species_genome,
+            view_window,
+            engine,
+            end_order,
+            stats[key]["max_length"] if stats is not None else None,
+            layout,
+            index,
+        )
+    except Exception as e:
+        print(e)
+        print(
+            f"Warning: could not find feature information for chromosome {key}. \
+              Results for these peaks are not included in the output."
+        )
+        return None
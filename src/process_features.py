@@ -11,9 +11,24 @@
 # https://github.com/vandydata/peakScout
 #
 # ------------------------------------------------------------------------------
+import os
 import polars as pl
 import numpy as np
-from collections import defaultdict
+import multiprocessing
+from typing import Union
+from concurrent.futures import ProcessPoolExecutor
+from reference import gen_end_order, build_interval_index
+
+# Output layouts: one row per peak with closest_<feature>_<i> columns for each of
+# the k nearest features (wide), or one row per peak and nearest feature (long).
+LAYOUTS = ["wide", "long"]
+
+# Least number of peaks per worker process. Every worker is a new Python process
+# that imports Polars and loads its references, and the peaks and results of
+# every chromosome are copied between processes, so with fewer peaks the
+# chromosomes are run in this process instead. PEAKSCOUT_MIN_WORKER_PEAKS
+# overrides it.
+MIN_WORKER_PEAKS = int(os.environ.get("PEAKSCOUT_MIN_WORKER_PEAKS", 500000))
 
 
 def get_nearest_features(
@@ -27,22 +42,37 @@ def get_nearest_features(
     drop_columns: bool,
     species_genome: str,
     view_window: float = 0.2,
+    engine: str = "batch",
+    end_order: np.ndarray = None,
+    max_length: int = None,
+    layout: str = "wide",
+    index: tuple = None,
 ) -> pl.DataFrame:
     """
     Determine the nearest k features to each peak in roi using the reference
-    starts and ends.
+    starts and ends with the requested engine. The end-ordered features may be
+    given either as ends or as the end_order permutation of starts.
 
     Parameters:
     roi (pl.DataFrame): Polars DataFrame containing peaks and relevant information.
     feature (str): The feature of interest.
     starts (pl.DataFrame): Polars DataFrame of reference features sorted by start position.
-    ends (pl.DataFrame): Polars DataFrame of reference features sorted by end position.
+    ends (pl.DataFrame): Polars DataFrame of reference features sorted by end position,
+                         or None to use end_order.
     up_bound (int): Maximum allowed distance between peak and upstream feature.
     down_bound (int): Maximum allowed distance between peak and downstream feature.
     k (int): Number of nearest features to collect.
     drop_columns (bool): Whether to drop unnecessary columns from the original file.
     species_genome (str): Species of the reference genome.
     view_window (float): Proportion of the peak region in entire genome browser window.
+    engine (str): Nearest feature engine, either 'batch' (vectorized) or 'legacy' (per peak).
+    end_order (np.ndarray): Row indices of starts sorted by end position. Computed
+                            from starts when neither ends nor end_order is given.
+    max_length (int): Length of the longest reference feature, used by the batch
+                      engine to bound its overlap search. Default None.
+    layout (str): Output layout, one of LAYOUTS (see gen_return_roi). Default 'wide'.
+    index (tuple): Interval index of starts (see load_interval_index), used by the
+                   batch engine. Built from starts if None. Default None.
 
     Returns:
     return_roi (pl.DataFrame): Polars DataFrame containing peak information, the
@@ -52,44 +82,215 @@ def get_nearest_features(
     Outputs:
     None
     """
+    if layout not in LAYOUTS:
+        raise ValueError("Invalid layout")
+
+    if engine == "batch":
+        return get_nearest_features_batch(
+            roi,
+            feature,
+            starts,
+            up_bound,
+            down_bound,
+            k,
+            drop_columns,
+            species_genome,
+            view_window,
+            end_order,
+            max_length,
+            layout,
+            index,
+        )
+    elif engine == "legacy":
+        if ends is None and end_order is None:
+            end_order = gen_end_order(starts)
+        return get_nearest_features_legacy(
+            roi,
+            feature,
+            starts,
+            ends,
+            up_bound,
+            down_bound,
+            k,
+            drop_columns,
+            species_genome,
+            view_window,
+            layout,
+            end_order,
+        )
+    else:
+        raise ValueError("Invalid engine")
 
-    starts_sub = starts.select(["start", "end"]).to_numpy()
-    ends_sub = ends.select("end").to_numpy().flatten()
-    assert len(starts_sub) == len(ends_sub)
 
-    start_features = starts.select(feature).to_numpy().flatten()
-    end_features = ends.select(feature).to_numpy().flatten()
+def get_nearest_features_batch(
+    roi: pl.DataFrame,
+    feature: str,
+    starts: pl.DataFrame,
+    up_bound: int,
+    down_bound: int,
+    k: int,
+    drop_columns: bool,
+    species_genome: str,
+    view_window: float = 0.2,
+    end_order: np.ndarray = None,
+    max_length: int = None,
+    layout: str = "wide",
+    index: tuple = None,
+) -> pl.DataFrame:
+    """
+    Determine the nearest k features to each peak in roi using the reference
+    starts. All peaks are processed at once: the upstream and downstream
+    candidates of every peak are gathered into arrays and merged into the
+    nearest k in a single vectorized pass. The result matches
+    get_nearest_features_legacy for peaks sorted by start position.
+
+    Parameters:
+    roi (pl.DataFrame): Polars DataFrame containing peaks and relevant information.
+    feature (str): The feature of interest.
+    starts (pl.DataFrame): Polars DataFrame of reference features sorted by start position.
+    up_bound (int): Maximum allowed distance between peak and upstream feature.
+    down_bound (int): Maximum allowed distance between peak and downstream feature.
+    k (int): Number of nearest features to collect.
+    drop_columns (bool): Whether to drop unnecessary columns from the original file.
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
+    end_order (np.ndarray): Row indices of starts sorted by end position. Computed
+                            from starts if None.
+    max_length (int): Length of the longest reference feature, bounding the overlap
+                      search. Default None.
+    layout (str): Output layout, one of LAYOUTS (see gen_return_roi). Default 'wide'.
+    index (tuple): Interval index of starts (see load_interval_index). Built from
+                   starts if None. Default None.
+
+    Returns:
+    return_roi (pl.DataFrame): Polars DataFrame containing peak information, the
+    nearest k features to that peak, and the distances between those k features
+    and the peak.
 
-    if feature == "gene_name":
-        start_gene_ids = starts.select("gene_id").to_numpy().flatten()
-        start_gene_types = starts.select("gene_type").to_numpy().flatten()
+    Outputs:
+    None
+    """
+
+    if drop_columns:
+        return_roi = roi.select(["name", "chr", "start", "end"])
+    else:
+        return_roi = roi
+
+    if index is None:
+        index = build_interval_index(
+            starts.get_column("start").to_numpy().astype(np.int64),
+            starts.get_column("end").to_numpy().astype(np.int64),
+        )
+
+    feature_idx, dists = nearest_feature_matrix(
+        return_roi.get_column("start").to_numpy().astype(np.int64),
+        return_roi.get_column("end").to_numpy().astype(np.int64),
+        index[0],
+        index[1],
+        up_bound,
+        down_bound,
+        k,
+        end_order,
+        max_length,
+        index,
+    )
+
+    return gen_return_roi(
+        return_roi,
+        feature,
+        starts,
+        feature_idx,
+        dists,
+        k,
+        species_genome,
+        view_window,
+        layout,
+    )
+
+
+def get_nearest_features_legacy(
+    roi: pl.DataFrame,
+    feature: str,
+    starts: pl.DataFrame,
+    ends: pl.DataFrame,
+    up_bound: int,
+    down_bound: int,
+    k: int,
+    drop_columns: bool,
+    species_genome: str,
+    view_window: float = 0.2,
+    layout: str = "wide",
+    end_order: np.ndarray = None,
+) -> pl.DataFrame:
+    """
+    Determine the nearest k features to each peak in roi using the reference
+    starts and ends, walking the peaks one at a time. The end-ordered features
+    may be given either as ends or as the end_order permutation of starts, in
+    which case only their end positions are gathered.
+
+    Parameters:
+    roi (pl.DataFrame): Polars DataFrame containing peaks and relevant information.
+    feature (str): The feature of interest.
+    starts (pl.DataFrame): Polars DataFrame of reference features sorted by start position.
+    ends (pl.DataFrame): Polars DataFrame of reference features sorted by end position,
+                         or None to use end_order.
+    up_bound (int): Maximum allowed distance between peak and upstream feature.
+    down_bound (int): Maximum allowed distance between peak and downstream feature.
+    k (int): Number of nearest features to collect.
+    drop_columns (bool): Whether to drop unnecessary columns from the original file.
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
+    layout (str): Output layout, one of LAYOUTS (see gen_return_roi). Default 'wide'.
+    end_order (np.ndarray): Row indices of starts sorted by end position. Only used
+                            when ends is None. Default None.
+
+    Returns:
+    return_roi (pl.DataFrame): Polars DataFrame containing peak information, the
+    nearest k features to that peak, and the distances between those k features
+    and the peak.
 
-        end_gene_ids = ends.select("gene_id").to_numpy().flatten()
-        end_gene_types = ends.select("gene_type").to_numpy().flatten()
+    Outputs:
+    None
+    """
+
+    starts_sub = starts.select(["start", "end"]).to_numpy()
+
+    if ends is None:
+        # Upstream hits are mapped back to their start-ordered rows.
+        end_rows = np.asarray(end_order)
+        ends_sub = starts_sub[end_rows, 1]
+        features = starts
     else:
-        start_gene_ids = start_gene_types = end_gene_ids = end_gene_types = None
+        # Hits are recorded as row indices into starts followed by ends, so the
+        # end-sorted rows are offset by the number of start-sorted rows.
+        ends_sub = ends.select("end").to_numpy().flatten()
+        ref_columns = (
+            [feature, "gene_id", "gene_type"] if feature == "gene_name" else [feature]
+        )
+        features = pl.concat([starts.select(ref_columns), ends.select(ref_columns)])
+        end_rows = len(starts_sub) + np.arange(len(ends_sub))
+    assert len(starts_sub) == len(ends_sub)
 
     if drop_columns:
-        return_roi = roi.select(["name", "chr", "start", "end"]).clone()
+        return_roi = roi.select(["name", "chr", "start", "end"])
     else:
-        return_roi = roi.clone()
+        return_roi = roi
 
     index = 0
 
-    overlap_features = []
+    active_features = []
     overlap_index = 0
 
-    features_to_add, dists_to_add, gene_info_to_add = gen_init(feature == "gene_name")
+    feature_idx, dists = gen_init(return_roi.height, k)
 
     for peak in return_roi.iter_rows(named=True):
         peak_start = peak["start"]
         peak_end = peak["end"]
 
-        # c_starts_sub, c_ends_sub, c_start_features, c_end_features
         ds_lower, ds_upper, us_lower, us_upper = constrain_features(
             peak_start,
             peak_end,
-            starts_sub,
+            starts_sub[:, 0],
             ends_sub,
             up_bound,
             down_bound,
@@ -98,46 +299,36 @@ def get_nearest_features(
         c_starts_sub = starts_sub[ds_lower:ds_upper]
         c_ends_sub = ends_sub[us_lower:us_upper]
 
-        c_start_features = start_features[ds_lower:ds_upper]
-        c_end_features = end_features[us_lower:us_upper]
-
-        if feature == "gene_name":
-            c_start_gene_ids = start_gene_ids[ds_lower:ds_upper]
-            c_end_gene_ids = end_gene_ids[us_lower:us_upper]
-
-            c_start_gene_types = start_gene_types[ds_lower:ds_upper]
-            c_end_gene_types = end_gene_types[us_lower:us_upper]
-        else:
-            c_start_gene_ids = c_end_gene_ids = c_start_gene_types = (
-                c_end_gene_types
-            ) = None
-
-        overlap_features, overlap_index = find_overlaps(
-            peak_start, peak_end, c_starts_sub, overlap_features, overlap_index
+        # Overlaps are tracked against the unsliced starts: the down_bound slice
+        # shrinks from one peak to the next when a peak lies within the previous one.
+        overlap_features, active_features, overlap_index = find_overlaps(
+            peak_start, peak_end, starts_sub, active_features, overlap_index
         )
+        overlap_features = [
+            overlap - ds_lower
+            for overlap in overlap_features
+            if ds_lower <= overlap < ds_upper
+        ]
 
         i = k
         overlap_ctr = 0
 
         while overlap_ctr < len(overlap_features) and i > 0:
             update_to_add(
-                features_to_add,
-                dists_to_add,
-                gene_info_to_add,
-                c_start_features,
-                c_start_gene_ids,
-                c_start_gene_types,
+                feature_idx,
+                dists,
+                index,
+                k - i,
+                ds_lower + overlap_features[overlap_ctr],
                 0,
-                k - i + 1,
-                overlap_features[overlap_ctr],
             )
             overlap_ctr += 1
             i -= 1
 
-        ds_index = overlap_index
-        us_index = len(c_end_features) - 1
+        ds_index = c_starts_sub[:, 0].searchsorted(peak_end, side="right")
+        us_index = len(c_ends_sub) - 1
 
-        while i > 0 and us_index > -1 and ds_index < len(c_start_features):
+        while i > 0 and us_index > -1 and ds_index < len(c_starts_sub):
             ds_dist = max(0, c_starts_sub[ds_index][0] - peak_end)
             us_dist = max(0, peak_start - c_ends_sub[us_index])
 
@@ -151,87 +342,289 @@ def get_nearest_features(
 
             if ds_dist < us_dist:
                 update_to_add(
-                    features_to_add,
-                    dists_to_add,
-                    gene_info_to_add,
-                    c_start_features,
-                    c_start_gene_ids,
-                    c_start_gene_types,
-                    ds_dist,
-                    k - i + 1,
-                    ds_index,
+                    feature_idx, dists, index, k - i, ds_lower + ds_index, ds_dist
                 )
                 ds_index += 1
             else:
                 update_to_add(
-                    features_to_add,
-                    dists_to_add,
-                    gene_info_to_add,
-                    c_end_features,
-                    c_end_gene_ids,
-                    c_end_gene_types,
+                    feature_idx,
+                    dists,
+                    index,
+                    k - i,
+                    end_rows[us_lower + us_index],
                     -1 * us_dist,
-                    k - i + 1,
-                    us_index,
                 )
                 us_index -= 1
 
             i -= 1
 
         if i > 0 and us_index < 0:
-            while i > 0 and ds_index < len(c_start_features):
+            while i > 0 and ds_index < len(c_starts_sub):
                 ds_dist = c_starts_sub[ds_index][0] - peak_end
                 ds_dist = max(0, ds_dist)
                 update_to_add(
-                    features_to_add,
-                    dists_to_add,
-                    gene_info_to_add,
-                    c_start_features,
-                    c_start_gene_ids,
-                    c_start_gene_types,
-                    ds_dist,
-                    k - i + 1,
-                    ds_index,
+                    feature_idx, dists, index, k - i, ds_lower + ds_index, ds_dist
                 )
                 ds_index += 1
                 i -= 1
-        elif i > 0 and ds_index >= len(c_start_features):
+        elif i > 0 and ds_index >= len(c_starts_sub):
             while i > 0 and us_index > -1:
                 us_dist = peak_start - c_ends_sub[us_index]
                 us_dist = max(0, us_dist)
                 update_to_add(
-                    features_to_add,
-                    dists_to_add,
-                    gene_info_to_add,
-                    c_end_features,
-                    c_end_gene_ids,
-                    c_end_gene_types,
+                    feature_idx,
+                    dists,
+                    index,
+                    k - i,
+                    end_rows[us_lower + us_index],
                     -1 * us_dist,
-                    k - i + 1,
-                    us_index,
                 )
                 us_index -= 1
                 i -= 1
 
-        while i > 0:
-            features_to_add[k - i + 1].append("N/A")
-            dists_to_add[k - i + 1].append("N/A")
-            gene_info_to_add["id"][k - i + 1].append("N/A")
-            gene_info_to_add["type"][k - i + 1].append("N/A")
-            i -= 1
-
         index += 1
 
     return gen_return_roi(
         return_roi,
         feature,
-        features_to_add,
-        dists_to_add,
-        gene_info_to_add,
+        features,
+        feature_idx,
+        dists,
         k,
         species_genome,
         view_window,
+        layout,
+    )
+
+
+def nearest_feature_matrix(
+    peak_starts: np.ndarray,
+    peak_ends: np.ndarray,
+    ref_starts: np.ndarray,
+    ref_ends: np.ndarray,
+    up_bound: int,
+    down_bound: int,
+    k: int,
+    end_order: np.ndarray = None,
+    max_length: int = None,
+    index: tuple = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the nearest k reference features for every peak at once. Overlapping
+    features come first, followed by a merge of the downstream candidates
+    (in start order) and upstream candidates (in end order) by distance, with
+    ties going to the upstream feature.
+
+    Parameters:
+    peak_starts (np.ndarray): NumPy array of start positions of peaks.
+    peak_ends (np.ndarray): NumPy array of end positions of peaks.
+    ref_starts (np.ndarray): NumPy array of start positions of reference features, sorted.
+    ref_ends (np.ndarray): NumPy array of end positions of reference features, in start order.
+    up_bound (int): Maximum allowed distance between peak and upstream feature.
+    down_bound (int): Maximum allowed distance between peak and downstream feature.
+    k (int): Number of nearest features to collect.
+    end_order (np.ndarray): Indices of the reference features sorted by end position,
+                            with ties in start order. Computed from ref_ends if None.
+    max_length (int): Length of the longest reference feature (see load_reference_stats),
+                      bounding the overlap search from below. Default None.
+    index (tuple): Interval index of ref_starts and ref_ends (see build_interval_index).
+                   Built here if None. Default None.
+
+    Returns:
+    feature_idx (np.ndarray): n x k NumPy array of indices into the reference features,
+                              -1 where there is no feature.
+    dists (np.ndarray): n x k NumPy array of distances between peak and feature
+                        (negative for upstream features).
+
+    Outputs:
+    None
+    """
+    if len(ref_starts) == 0:
+        return gen_init(len(peak_starts), k)
+
+    if end_order is None:
+        end_order = np.argsort(ref_ends, kind="stable")
+    end_order = np.asarray(end_order)
+    sorted_ends = ref_ends[end_order]
+
+    ds_lower, ds_upper, us_lower, us_upper = constrain_features(
+        peak_starts,
+        peak_ends,
+        ref_starts,
+        sorted_ends,
+        up_bound,
+        down_bound,
+        max_length,
     )
+    ds_lower = np.broadcast_to(ds_lower, peak_starts.shape)
+    ds_upper = np.broadcast_to(ds_upper, peak_starts.shape)
+    us_lower = np.broadcast_to(us_lower, peak_starts.shape)
+
+    # Features starting at or before the peak end can only be overlaps;
+    # everything after them (up to ds_upper) is a downstream candidate.
+    overlap_upper = np.minimum(
+        ref_starts.searchsorted(peak_ends, side="right"), ds_upper
+    )
+    overlap_idx, num_overlaps = find_overlaps_batch(
+        peak_starts,
+        peak_ends,
+        index if index is not None else build_interval_index(ref_starts, ref_ends),
+        overlap_upper,
+        k,
+        lowers=ds_lower,
+    )
+
+    num_ds = np.maximum(ds_upper - overlap_upper, 0)
+
+    # Features ending inside the peak are skipped while downstream candidates
+    # remain, and reported with distance 0 once only upstream ones are left.
+    us_top = np.where(
+        num_ds > 0,
+        np.minimum(sorted_ends.searchsorted(peak_starts, side="left"), us_upper),
+        us_upper,
+    )
+    num_us = np.maximum(us_top - us_lower, 0)
+
+    offsets = np.arange(k)
+
+    ds_pos = overlap_upper[:, None] + offsets
+    ds_valid = offsets < num_ds[:, None]
+    ds_pos = np.where(ds_valid, ds_pos, 0)
+    ds_dists = np.where(ds_valid, ref_starts[ds_pos] - peak_ends[:, None], 0)
+
+    us_pos = us_top[:, None] - 1 - offsets
+    us_valid = offsets < num_us[:, None]
+    us_pos = np.where(us_valid, us_pos, 0)
+    us_dists = np.where(
+        us_valid, np.maximum(peak_starts[:, None] - sorted_ends[us_pos], 0), 0
+    )
+
+    # Upstream candidates come first so that a stable sort resolves equal
+    # distances in favour of the upstream feature.
+    cand_idx = np.concatenate([end_order[us_pos], ds_pos], axis=1)
+    cand_dists = np.concatenate([-us_dists, ds_dists], axis=1)
+    cand_valid = np.concatenate([us_valid, ds_valid], axis=1)
+    cand_key = np.where(cand_valid, np.abs(cand_dists), np.iinfo(np.int64).max)
+    order = np.argsort(cand_key, axis=1, kind="stable")
+
+    rows = np.arange(len(peak_starts))[:, None]
+    rank = offsets[None, :] - num_overlaps[:, None]
+    from_cand = rank >= 0
+    rank = np.where(from_cand, rank, 0)
+    picked = order[rows, rank]
+
+    feature_idx = np.where(
+        from_cand, cand_idx[rows, picked], overlap_idx[rows, offsets]
+    )
+    dists = np.where(from_cand, cand_dists[rows, picked], 0)
+    valid = np.where(from_cand, cand_valid[rows, picked], True)
+
+    return np.where(valid, feature_idx, -1), np.where(valid, dists, 0)
+
+
+def take_features(values: pl.Series, index: np.ndarray) -> pl.Series:
+    """
+    Gather reference values at the given indices, with null wherever there is
+    no feature. Dictionary-encoded reference values are decoded to strings here,
+    for the gathered rows only.
+
+    Parameters:
+    values (pl.Series): Polars Series of reference values to gather from.
+    index (np.ndarray): NumPy array of indices into values, -1 where there is no feature.
+
+    Returns:
+    taken (pl.Series): Polars Series of gathered values.
+
+    Outputs:
+    None
+    """
+    dtype = pl.String if values.dtype == pl.Categorical else values.dtype
+
+    missing = np.flatnonzero(index < 0)
+    if len(missing) == len(index):
+        return pl.Series(values.name, [None] * len(index), dtype=dtype)
+
+    taken = values.gather(np.where(index < 0, 0, index)).cast(dtype)
+    if len(missing):
+        taken = taken.scatter(missing, None)
+    return taken
+
+
+def find_overlaps_batch(
+    peak_starts: np.ndarray,
+    peak_ends: np.ndarray,
+    index: tuple[np.ndarray, np.ndarray, np.ndarray],
+    uppers: np.ndarray,
+    k: int,
+    block_size: int = 64,
+    lowers: np.ndarray = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Find the indices of the first k features (in start order) that overlap
+    each peak using the interval index. Only features between the first one
+    whose running maximum end reaches the peak start and the last one starting
+    before the peak end are examined, block_size features at a time for all
+    peaks that still need overlaps.
+
+    Parameters:
+    peak_starts (np.ndarray): NumPy array of start positions of peaks.
+    peak_ends (np.ndarray): NumPy array of end positions of peaks.
+    index (tuple): Interval index of the reference features from build_interval_index.
+    uppers (np.ndarray): NumPy array with, for each peak, the index of the first
+                         feature in starts that begins after the peak ends.
+    k (int): Maximum number of overlapping features to collect per peak.
+    block_size (int): Number of candidate features examined per peak in each step.
+    lowers (np.ndarray): NumPy array with, for each peak, an index in starts before which
+                         no feature can overlap it (e.g. ds_lower from constrain_features).
+                         Default None.
+
+    Returns:
+    overlap_idx (np.ndarray): n x k NumPy array of overlapping feature indices.
+    num_overlaps (np.ndarray): NumPy array with the number of overlaps found per peak.
+
+    Outputs:
+    None
+    """
+    starts, ends, max_ends = index
+
+    overlap_idx = np.zeros((len(peak_starts), k), dtype=np.int64)
+    num_overlaps = np.zeros(len(peak_starts), dtype=np.int64)
+
+    if lowers is None:
+        lowers = max_ends.searchsorted(peak_starts, side="left")
+    else:
+        lowers = np.maximum(lowers, max_ends.searchsorted(peak_starts, side="left"))
+    active = np.flatnonzero(lowers < uppers)
+    positions = lowers[active]
+    offsets = np.arange(block_size)
+
+    while len(active) and k > 0:
+        candidates = positions[:, None] + offsets
+        in_window = candidates < uppers[active, None]
+        candidates = np.where(in_window, candidates, 0)
+
+        active_starts = peak_starts[active, None]
+        # Same overlap rule as check_overlap: a feature overlaps when it
+        # contains either the peak start or the peak end.
+        hits = in_window & (
+            (
+                (starts[candidates] <= active_starts)
+                & (ends[candidates] >= active_starts)
+            )
+            | (ends[candidates] >= peak_ends[active, None])
+        )
+
+        ranks = np.cumsum(hits, axis=1) - 1 + num_overlaps[active, None]
+        rows, cols = np.nonzero(hits & (ranks < k))
+        overlap_idx[active[rows], ranks[rows, cols]] = candidates[rows, cols]
+        num_overlaps[active] = np.minimum(num_overlaps[active] + hits.sum(axis=1), k)
+
+        positions = positions + block_size
+        remaining = (num_overlaps[active] < k) & (positions < uppers[active])
+        active = active[remaining]
+        positions = positions[remaining]
+
+    return overlap_idx, num_overlaps
 
 
 def constrain_features(
@@ -241,19 +634,24 @@ def constrain_features(
     ends: np.ndarray,
     up_bound: int,
     down_bound: int,
+    max_length: int = None,
 ) -> tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
     """
     Constrain the reference start and ends features contain only valid features --
     those within down_bound/up_bound distance of the peak and those on one
-    particular side of the peak.
+    particular side of the peak. With the length of the longest reference
+    feature, features that start too far before the peak to reach it are
+    excluded from the start positions as well.
 
     Parameters:
-    peak_start (int): Start position of peak.
-    peak_end (int): End position of peak.
+    peak_start (int): Start position of peak, or NumPy array of peak start positions.
+    peak_end (int): End position of peak, or NumPy array of peak end positions.
     starts (np.ndarray): NumPy array of start positions of reference features.
     ends (np.ndarray): NumPy array of end positions of reference features.
     up_bound (int): Maximum allowed distance between peak and upstream feature.
     down_bound (int): Maximum allowed distance between peak and downstream feature.
+    max_length (int): Length (end - start) of the longest reference feature, or None
+                      if unknown. Default None.
 
     Returns:
     ds_lower (int): Lower index of constrained start positions of reference features.
@@ -274,7 +672,11 @@ def constrain_features(
     else:
         us_lower = 0
 
-    ds_lower = 0
+    if max_length is not None:
+        ds_lower = starts.searchsorted(peak_start - max_length, side="left")
+    else:
+        ds_lower = 0
+
     us_upper = ends.searchsorted(peak_end, side="right")
 
     return ds_lower, ds_upper, us_lower, us_upper
@@ -307,107 +709,218 @@ def find_overlaps(
     peak_start: int,
     peak_end: int,
     starts: np.ndarray,
-    overlap_features: list,
+    active_features: list,
     overlap_index: int,
-) -> tuple[list, int]:
+) -> tuple[list, list, int]:
     """
-    Find the indicies of genes that overlap with the peak.
+    Find the indicies of genes that overlap with the peak. Peaks are visited in start
+    order, so features ending before the peak start can be dropped for good, while
+    features scanned for an earlier peak that ends after this one are kept until a
+    later peak reaches them.
 
     Parameters:
     peak_start (int): Start position of peak.
     peak_end (int): End position of peak.
-    starts (np.ndarray): NumPy array of start positions of reference features.
-    overlap_features (list): A list of overlapping features from the previous peak. If this is the first peak, this list is empty.
-    overlap_index (int): The index of the first feature in starts that begins after the previous peak ends. If this is the first peak, this integer is 0.
+    starts (np.ndarray): NumPy array of start and end positions of reference features, sorted by start.
+    active_features (list): Features scanned for the previous peaks that may still overlap a later peak. If this is the first peak, this list is empty.
+    overlap_index (int): The index of the first feature in starts that has not been scanned yet. If this is the first peak, this integer is 0.
 
     Returns:
-    overlap_features (list): A list of overlapping features for the given peak.
-    overlap_index (int): Index of the first feature in starts that begins after the current peak ends.
+    overlap_features (list): A list of overlapping features for the given peak, in start order.
+    active_features (list): Features scanned so far that end at or after the peak start.
+    overlap_index (int): Index of the first feature in starts that begins after the peaks so far end.
 
     Outputs:
     None
     """
-    for gene in overlap_features:
-        if not check_overlap(peak_start, peak_end, starts, gene):
-            overlap_features.remove(gene)
+    active_features = [
+        gene for gene in active_features if starts[gene][1] >= peak_start
+    ]
 
     while len(starts) > overlap_index and starts[overlap_index][0] <= peak_end:
-        if check_overlap(peak_start, peak_end, starts, overlap_index):
-            overlap_features.append(overlap_index)
+        if starts[overlap_index][1] >= peak_start:
+            active_features.append(overlap_index)
         overlap_index += 1
 
-    return overlap_features, overlap_index
+    overlap_features = [
+        gene
+        for gene in active_features
+        if check_overlap(peak_start, peak_end, starts, gene)
+    ]
+
+    return overlap_features, active_features, overlap_index
 
 
 def gen_return_roi(
     return_roi: pl.DataFrame,
     feature: str,
-    features_to_add: dict,
-    dists_to_add: dict,
-    gene_info_to_add: dict,
+    features: pl.DataFrame,
+    feature_idx: np.ndarray,
+    dists: np.ndarray,
     k: int,
     species_genome: str,
     view_window: float = 0.2,
+    layout: str = "wide",
 ) -> pl.DataFrame:
     """
     Generates Polars DataFrame containing peak information, the nearest k features to that peak,
-    and the distances between those k features and the peak.
+    and the distances between those k features and the peak. In the wide layout each peak has
+    one row with closest_<feature>_<i> columns for i in 1..k; in the long layout each peak has k
+    rows, numbered by rank, with closest_<feature> columns for the feature at that rank.
 
     Parameters:
     return_roi (pl.DataFrame): Skeleton for return Polars DataFrame with all necessary columns.
     feature (str): Feature in question.
-    features_to_add (dict): Dictionary that maps integer n with a list of the nth closest feature.
-    dists_to_add (dict): Dictionary that maps integer n with a list of the distance between the peak and the nth closest feature.
-    gene_info_to_add (dict): Dictionary that maps 'id' and 'type' to dictionaries that map integer n with a list of the gene id/type of the nth closest feature. If feature is not 'gene_name', this is None.
+    features (pl.DataFrame): Polars DataFrame of reference features that feature_idx points into.
+    feature_idx (np.ndarray): n x k NumPy array of indices of the nearest features in features,
+                              -1 where there is no feature.
+    dists (np.ndarray): n x k NumPy array of distances between the peak and the nearest features.
     k (int): Number of closest features to determine.
     species_genome (str): Species of the reference genome.
     view_window (float): Proportion of the peak region in entire genome browser window.
+    layout (str): Output layout, either 'wide' or 'long'. Default 'wide'.
 
     Returns:
     return_roi (pl.DataFrame): Polars DataFrame containing peak information, the nearest k features to that peak,
-    and the distances between those k features and the peak.
+    and the distances between those k features and the peak. Missing features and distances are null.
 
     Outputs:
     None
     """
+    if layout == "long":
+        return gen_return_roi_long(
+            return_roi,
+            feature,
+            features,
+            feature_idx,
+            dists,
+            k,
+            species_genome,
+            view_window,
+        )
+
+    columns = []
     for i in range(1, k + 1):
-        return_roi = return_roi.with_columns(
-            [
-                pl.Series("closest_" + feature + "_" + str(i), features_to_add[i]),
-                pl.Series(
-                    "closest_" + feature + "_" + str(i) + "_dist", dists_to_add[i]
-                ),
-            ]
+        col_name = "closest_" + feature + "_" + str(i)
+        index = feature_idx[:, i - 1]
+        missing = np.flatnonzero(index < 0)
+
+        columns.append(
+            take_features(features.get_column(feature), index).alias(col_name)
+        )
+        columns.append(
+            pl.Series(col_name + "_dist", dists[:, i - 1]).scatter(missing, None)
         )
 
-        if gene_info_to_add is not None:
-            return_roi = return_roi.with_columns(
-                [
-                    pl.Series(
-                        "closest_" + feature + "_" + str(i) + "_gene_id",
-                        gene_info_to_add["id"][i],
-                    ),
-                    pl.Series(
-                        "closest_" + feature + "_" + str(i) + "_gene_type",
-                        gene_info_to_add["type"][i],
-                    ),
-                ]
+        if feature == "gene_name":
+            columns.append(
+                take_features(features.get_column("gene_id"), index).alias(
+                    col_name + "_gene_id"
+                )
+            )
+            columns.append(
+                take_features(features.get_column("gene_type"), index).alias(
+                    col_name + "_gene_type"
+                )
             )
 
     if species_genome:
-        species_genome_col = get_ucsc_browser_urls(
-            species_genome, return_roi, view_window
+        columns.append(get_ucsc_browser_urls(species_genome, return_roi, view_window))
+
+    return return_roi.hstack(columns)
+
+
+def gen_return_roi_long(
+    return_roi: pl.DataFrame,
+    feature: str,
+    features: pl.DataFrame,
+    feature_idx: np.ndarray,
+    dists: np.ndarray,
+    k: int,
+    species_genome: str,
+    view_window: float = 0.2,
+) -> pl.DataFrame:
+    """
+    Generates the long layout of gen_return_roi: every peak is repeated once per rank
+    1..k, next to the feature at that rank taken straight from the flattened
+    feature_idx and dists arrays. Distances are integers and features that could not
+    be found are null, so peaks keep all k rows.
+
+    Parameters:
+    return_roi (pl.DataFrame): Skeleton for return Polars DataFrame with all necessary columns.
+    feature (str): Feature in question.
+    features (pl.DataFrame): Polars DataFrame of reference features that feature_idx points into.
+    feature_idx (np.ndarray): n x k NumPy array of indices of the nearest features in features,
+                              -1 where there is no feature.
+    dists (np.ndarray): n x k NumPy array of distances between the peak and the nearest features.
+    k (int): Number of closest features to determine.
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
+
+    Returns:
+    return_roi (pl.DataFrame): Polars DataFrame with k rows per peak containing peak information,
+    the rank, the feature at that rank and its distance to the peak.
+
+    Outputs:
+    None
+    """
+    rows = np.repeat(np.arange(return_roi.height), k)
+    index = feature_idx.ravel()
+    missing = np.flatnonzero(index < 0)
+    col_name = "closest_" + feature
+
+    columns = [
+        pl.Series(
+            "rank", np.tile(np.arange(1, k + 1, dtype=np.int64), return_roi.height)
+        ),
+        take_features(features.get_column(feature), index).alias(col_name),
+        pl.Series(col_name + "_dist", dists.ravel()).scatter(missing, None),
+    ]
+    if feature == "gene_name":
+        columns.append(
+            take_features(features.get_column("gene_id"), index).alias(
+                col_name + "_gene_id"
+            )
         )
-        return_roi = return_roi.with_columns(
-            pl.Series("ucsc_genome_browser_urls", species_genome_col)
+        columns.append(
+            take_features(features.get_column("gene_type"), index).alias(
+                col_name + "_gene_type"
+            )
         )
 
-    return return_roi
+    if species_genome:
+        columns.append(
+            get_ucsc_browser_urls(species_genome, return_roi, view_window).gather(rows)
+        )
+
+    return return_roi[rows].hstack(columns)
+
+
+def fill_missing_features(output: pl.DataFrame, missing: str = "N/A") -> pl.DataFrame:
+    """
+    Replace null nearest feature entries with a placeholder for text outputs.
+    Columns without nulls keep their type.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame returned by get_nearest_features.
+    missing (str): Placeholder for features that could not be found. Default 'N/A'.
+
+    Returns:
+    output (pl.DataFrame): Polars DataFrame with null nearest feature entries replaced.
+
+    Outputs:
+    None
+    """
+    return output.with_columns(
+        pl.col(col).cast(pl.String).fill_null(missing)
+        for col in output.columns
+        if col.startswith("closest_") and output.get_column(col).null_count()
+    )
 
 
 def get_ucsc_browser_urls(
     species_genome: str, df: pl.DataFrame, view_window: float = 0.2
-) -> list:
+) -> pl.Series:
     """
     Generates UCSC Genome Browser URLs for each peak in the DataFrame.
 
@@ -417,99 +930,152 @@ def get_ucsc_browser_urls(
     view_window (float): Proportion of the peak region in entire genome browser window.
 
     Returns:
-    urls (list): List of UCSC Genome Browser URLs for each peak.
+    urls (pl.Series): Polars Series of UCSC Genome Browser URLs for each peak.
 
     Outputs:
     None
     """
-    base_url = (
-        "https://genome.ucsc.edu/cgi-bin/hgTracks?db=" + species_genome + "&position="
-    )
-    highlight = "&highlight="
-    urls = []
+    return df.select(ucsc_browser_urls(species_genome, view_window)).to_series()
+
+
+def add_ucsc_browser_urls(
+    df: pl.DataFrame, species_genome: str, view_window: float = 0.2
+) -> pl.DataFrame:
+    """
+    Appends the UCSC Genome Browser URL column to the DataFrame. Does nothing if
+    no species is given.
+
+    Parameters:
+    df (pl.DataFrame): Polars DataFrame containing peak information.
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
 
-    for row in df.iter_rows(named=True):
-        chr = row["chr"]
-        start = row["start"]
-        end = row["end"]
-        peak_length = end - start
-        window_start = max(1, int(start - peak_length / ((1 - view_window) / 2)))
-        window_end = int(end + peak_length / ((1 - view_window) / 2))
-        url = f"{base_url}chr{chr}:{window_start}-{window_end}{highlight}chr{chr}:{start}-{end}"
-        urls.append(url)
+    Returns:
+    df (pl.DataFrame): Polars DataFrame with the ucsc_genome_browser_urls column added.
 
-    return urls
+    Outputs:
+    None
+    """
+    if not species_genome:
+        return df
+    return df.with_columns(ucsc_browser_urls(species_genome, view_window))
 
 
-def gen_init(gene: bool) -> tuple[dict, dict]:
+def ucsc_browser_urls(species_genome: str, view_window: float = 0.2) -> pl.Expr:
     """
-    Generates dictionaries to add to Polars DataFrame skeleton for nearest feature information.
+    Builds the Polars expression computing the UCSC Genome Browser URL of each peak
+    from its chr, start and end columns. The browser window is widened on both
+    sides so that the peak takes up view_window of it.
 
     Parameters:
-    gene (bool): If the feature of interest is 'gene_name', then additional information
+    species_genome (str): Species of the reference genome.
+    view_window (float): Proportion of the peak region in entire genome browser window.
 
     Returns:
-    features_to_add (dict): Dictionary that maps integer n with a list of the nth closest feature.
-    dists_to_add (dict): Dictionary that maps integer n with a list of the distance between the peak and the nth closest feature.
-    gene_info_to_add (dict): Dictionary that maps 'id' and 'type' to dictionaries that map integer n with a list of the gene id/type of the nth closest feature. If feature is not 'gene_name', this is None.
+    urls (pl.Expr): Polars expression named ucsc_genome_browser_urls.
 
     Outputs:
     None
     """
+    base_url = (
+        "https://genome.ucsc.edu/cgi-bin/hgTracks?db=" + species_genome + "&position="
+    )
+    highlight = "&highlight="
 
-    features_to_add = defaultdict(list)
-    dists_to_add = defaultdict(list)
-    gene_info_to_add = (
-        {"id": defaultdict(list), "type": defaultdict(list)} if gene else None
+    chr = pl.col("chr").cast(pl.String)
+    chr = (
+        pl.when(chr.str.contains("chr", literal=True)).then(chr).otherwise("chr" + chr)
     )
+    start = pl.col("start")
+    end = pl.col("end")
+    flank = (end - start) / ((1 - view_window) / 2)
+    window_start = (start - flank).cast(pl.Int64).clip(lower_bound=1)
+    window_end = (end + flank).cast(pl.Int64)
+
+    return pl.concat_str(
+        [
+            pl.lit(base_url),
+            chr,
+            pl.lit(":"),
+            window_start,
+            pl.lit("-"),
+            window_end,
+            pl.lit(highlight),
+            chr,
+            pl.lit(":"),
+            start,
+            pl.lit("-"),
+            end,
+        ]
+    ).alias("ucsc_genome_browser_urls")
+
+
+def gen_init(num_peaks: int, k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Generates preallocated arrays to hold the nearest feature information of every peak.
+
+    Parameters:
+    num_peaks (int): Number of peaks.
+    k (int): Number of closest features to determine.
+
+    Returns:
+    feature_idx (np.ndarray): num_peaks x k NumPy array of indices of the nearest features,
+                              initialised to -1 (no feature).
+    dists (np.ndarray): num_peaks x k NumPy array of distances between the peak and the
+                        nearest features, initialised to 0.
 
-    return features_to_add, dists_to_add, gene_info_to_add
+    Outputs:
+    None
+    """
+
+    feature_idx = np.full((num_peaks, k), -1, dtype=np.int64)
+    dists = np.zeros((num_peaks, k), dtype=np.int64)
+
+    return feature_idx, dists
 
 
 def update_to_add(
-    add_features: dict,
-    add_dists: dict,
-    add_gene_info: dict,
-    features: np.ndarray,
-    gene_ids: np.ndarray,
-    gene_types: np.ndarray,
-    dist: int,
-    add_index: int,
+    feature_idx: np.ndarray,
+    dists: np.ndarray,
+    peak_index: int,
+    rank: int,
     feature_index: int,
+    dist: int,
 ) -> None:
     """
-    Adds a feature and its distance from a peak to given dictionaries.
+    Records a feature and its distance from a peak in the preallocated arrays.
 
     Parameters:
-    add_features (dict): Dictionary that maps integer n with a list of the nth closest feature.
-    add_dists (dict): Dictionary that maps integer n with a list of the distance between the peak and the nth closest feature.
-    add_gene_info (dict): Dictionary that maps 'id' and 'type' to dictionaries that map integer n with a list of the gene id/type of the nth closest feature. If feature is not 'gene_name', this is None.
-    features (np.ndarray): NumPy array containing list of features.
-    gene_ids (np.ndarray): NumPy array containing list of gene ids. If feature is not 'gene_name', this is None.
-    gene_types (np.ndarray): NumPy array containing list of gene types. If feature is not 'gene_name', this is None.
-    dist (int): Distance to add to dictionary.
-    add_index (int): Index of peak for updating.
-    feature_index (int): Index of feature.
+    feature_idx (np.ndarray): NumPy array of indices of the nearest features.
+    dists (np.ndarray): NumPy array of distances between the peak and the nearest features.
+    peak_index (int): Index of the peak.
+    rank (int): Rank of the feature among the nearest features of the peak (0 is nearest).
+    feature_index (int): Index of the feature.
+    dist (int): Distance between the peak and the feature.
 
     Returns:
     None
 
     Outputs:
-    Updates add_features, add_dists, and add_gene_info to contain the newest feature, dist, and additional information.
+    Updates feature_idx and dists to contain the newest feature and distance.
     """
-    add_features[add_index].append(features[feature_index])
-    add_dists[add_index].append(str(dist))
-    if add_gene_info is not None:
-        add_gene_info["id"][add_index].append(gene_ids[feature_index])
-        add_gene_info["type"][add_index].append(gene_types[feature_index])
+    feature_idx[peak_index, rank] = feature_index
+    dists[peak_index, rank] = dist
 
 
-def decompose_features(features: pl.DataFrame) -> dict:
+def decompose_features(features: Union[pl.DataFrame, pl.LazyFrame]) -> dict:
     """
-    Decompose features by chromosome.
+    Decompose features by chromosome, each sorted by start position. A LazyFrame
+    is collected here, so that reading the input and adjusting the coordinates
+    run as one query. When the rows of every chromosome are contiguous, as in
+    peak files sorted by chromosome, each chromosome is a zero-copy slice of
+    features and only chromosomes not already sorted by start are sorted;
+    otherwise the rows are first gathered by chromosome. Chromosome names are
+    prefixed with 'chr' where missing, without changing the chr column.
 
     Parameters:
-    features (pl.DataFrame): Polars DataFrame containing feature information.
+    features (Union[pl.DataFrame, pl.LazyFrame]): Polars DataFrame or LazyFrame
+                                                  containing feature information.
 
     Returns:
     decomposed_features (dict): Dictionary containing keys with chromosome number
@@ -519,11 +1085,180 @@ def decompose_features(features: pl.DataFrame) -> dict:
     None
     """
 
-    decomposed_feat = {
-        "chr" + str(name[0]) if "chr" not in str(name[0]) else str(name[0]): group
-        for name, group in features.group_by(["chr"])
-    }
-    for key in decomposed_feat:
-        decomposed_feat[key] = decomposed_feat[key].sort("start")
+    features = features.lazy().collect()
+
+    runs = features.get_column("chr").rle().struct.unnest()
+    keys = chromosome_keys(runs.get_column("value"))
+    if keys.is_duplicated().any():
+        keys = chromosome_keys(features.get_column("chr"))
+        order = keys.to_frame().select(pl.arg_sort_by("chr", maintain_order=True))
+        order = order.to_series()
+        features = features[order]
+        runs = keys[order].rle().struct.unnest()
+        keys = runs.get_column("value")
+
+    starts = features.get_column("start")
+    decomposed_feat = {}
+    offset = 0
+    for key, length in zip(keys, runs.get_column("len")):
+        group = features.slice(offset, length)
+        if not starts.slice(offset, length).is_sorted():
+            group = group.sort("start", maintain_order=True)
+        decomposed_feat[key] = group
+        offset += length
 
     return decomposed_feat
+
+
+def chromosome_keys(chromosomes: pl.Series) -> pl.Series:
+    """
+    Prefix chromosome names with 'chr' where they do not contain it (e.g. 1 -> chr1).
+
+    Parameters:
+    chromosomes (pl.Series): Polars Series of chromosome names or numbers.
+
+    Returns:
+    keys (pl.Series): Polars Series of chromosome names.
+
+    Outputs:
+    None
+    """
+    chromosomes = chromosomes.cast(pl.String)
+    return (
+        pl.select(
+            pl.when(chromosomes.str.contains("chr", literal=True))
+            .then(chromosomes)
+            .otherwise("chr" + chromosomes)
+        )
+        .to_series()
+        .alias("chr")
+    )
+
+
+def chromosome_order(decomposed_features: dict) -> list:
+    """
+    Order decomposed chromosomes as they appear in the output, i.e. by their
+    chromosome names as written in the chr column.
+
+    Parameters:
+    decomposed_features (dict): Dictionary containing keys with chromosome number
+                                mapped to Polars DataFrames with features on that chromosome.
+
+    Returns:
+    keys (list): Keys of decomposed_features in output order.
+
+    Outputs:
+    None
+    """
+    return sorted(
+        decomposed_features,
+        key=lambda key: decomposed_features[key].get_column("chr").min(),
+    )
+
+
+def sort_chromosome(output: pl.DataFrame, by: str) -> pl.DataFrame:
+    """
+    Sort the results of one chromosome by the given column, unless they already
+    are sorted by it (as results for decomposed features are by start). Results
+    for chromosome names written both with and without 'chr' are sorted by the
+    chr column first.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing the results of one chromosome.
+    by (str): Column to order the rows by.
+
+    Returns:
+    output (pl.DataFrame): Polars DataFrame with the rows in output order.
+
+    Outputs:
+    None
+    """
+    if output.get_column("chr").n_unique() > 1:
+        return output.sort(["chr", by], maintain_order=True)
+    if output.get_column(by).is_sorted():
+        return output
+
+    return output.sort(by, maintain_order=True)
+
+
+def gen_process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Start a pool of worker processes to run chromosomes on (see iter_chromosomes).
+    Workers are spawned, as they do not inherit the Polars thread pool of this
+    process. A pool kept for several calls keeps the references cached in its
+    workers.
+
+    Parameters:
+    workers (int): Number of worker processes.
+
+    Returns:
+    pool (ProcessPoolExecutor): The pool of worker processes.
+
+    Outputs:
+    None
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+    )
+
+
+def iter_chromosomes(
+    function,
+    tasks: dict,
+    sizes: dict = None,
+    workers: int = 1,
+    pool: ProcessPoolExecutor = None,
+):
+    """
+    Run function once per chromosome, optionally on a pool of worker processes,
+    and yield the results in the order of tasks as soon as each is available,
+    so that the results of earlier chromosomes can be written while later ones
+    are computed. A pool starts the chromosomes largest first, so that the
+    longest tasks do not start last, except that the next chromosome to be
+    yielded is always started. At most two chromosomes per worker are started
+    ahead of the one being yielded, which bounds the number of results held
+    at once. With sizes, no more workers are used than there are
+    MIN_WORKER_PEAKS peaks in total, so small inputs are run in this process.
+
+    Parameters:
+    function (callable): Module-level function to run for each chromosome.
+    tasks (dict): Dictionary mapping chromosome to the tuple of arguments for function.
+    sizes (dict): Dictionary mapping chromosome to its number of peaks, or None to start
+                  the chromosomes in the order of tasks. Default None.
+    workers (int): Number of worker processes. With 1 the chromosomes are run in this process.
+    pool (ProcessPoolExecutor): Pool of workers worker processes to use and leave running
+                                (see gen_process_pool), or None to start one for this
+                                call. Default None.
+
+    Returns:
+    results (generator): Generator of (chromosome, value returned by function) tuples.
+
+    Outputs:
+    None
+    """
+    if workers is not None and sizes is not None and MIN_WORKER_PEAKS > 0:
+        workers = min(workers, sum(sizes.values()) // MIN_WORKER_PEAKS)
+
+    if workers is None or workers <= 1 or len(tasks) <= 1:
+        for key, args in tasks.items():
+            yield key, function(*args)
+        return
+
+    if pool is None:
+        with gen_process_pool(min(workers, len(tasks))) as pool:
+            yield from iter_chromosomes(function, tasks, sizes, workers, pool)
+        return
+
+    queue = list(tasks)
+    if sizes is not None:
+        queue.sort(key=lambda key: sizes[key], reverse=True)
+
+    futures = {}
+    for key in tasks:
+        if key not in futures:
+            queue.remove(key)
+            futures[key] = pool.submit(function, *tasks[key])
+        while queue and len(futures) < 2 * workers:
+            next_key = queue.pop(0)
+            futures[next_key] = pool.submit(function, *tasks[next_key])
+        yield key, futures.pop(key).result()
@@ -13,14 +13,32 @@
 # ------------------------------------------------------------------------------
 
 import polars as pl
-import os
+import pyarrow as pa
+import pyarrow.csv as pcsv
+import io
+import itertools
+from polars.io.plugins import register_io_source
+from reference import load_reference, load_name_index
+
+COMPRESSION_SUFFIXES = [".gz", ".bgz", ".zst", ".zstd"]
 
 
 def process_peaks(
-    file_path: str, peak_type: str, option: str, boundary: int, consensus: bool
-) -> pl.DataFrame:
+    file_path: str,
+    peak_type: str,
+    option: str,
+    boundary: int,
+    consensus: bool,
+    source=None,
+    columns: list = None,
+) -> pl.LazyFrame:
     """
-    Read in peak data and create a Polars DataFrame to hold the data.
+    Build a Polars LazyFrame that reads in peak data and adjusts the peak start and
+    end positions. Nothing is read until the LazyFrame is collected, and only the
+    columns needed for the collected result are parsed. gzip, bgzip and zstd
+    compressed peak files are decompressed while they are parsed; the format is
+    detected from the path without its compression suffix (e.g.
+    peaks.narrowPeak.gz is read as peaks.narrowPeak).
 
     Parameters:
     file_path (str): Path to the peak file.
@@ -28,53 +46,251 @@ def process_peaks(
     option (str): Option for defining start and end positions of peaks.
     boundary (int): Boundary for artificial peak boundary option. None if other options.
     consensus (bool): Whether to use consensus peaks.
+    source (file-like): File-like object holding the peak data to read instead of
+                        file_path, which still determines the format. Default None.
+    columns (list): Columns to keep, or None to keep all columns of the input file.
+                    Default None.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
     None
     """
 
+    if source is None:
+        source = file_path
+    file_path = strip_compression_suffix(file_path)
+
     if peak_type == "MACS2" and "xls" in file_path and not consensus:
-        peaks = read_input_MACS2_xls(file_path)
+        peaks = read_input_MACS2_xls(source)
     elif peak_type == "MACS2" and "bed" in file_path and not consensus:
-        peaks = read_input_MACS2_bed(file_path)
+        peaks = read_input_MACS2_bed(source)
     elif peak_type == "MACS2" and "narrowPeak" in file_path and not consensus:
-        peaks = read_input_MACS2_bed(file_path)
+        peaks = read_input_MACS2_bed(source)
     elif peak_type == "MACS2" and "bed" in file_path and consensus:
-        peaks = read_input_MACS2_bed_consensus(file_path)
+        peaks = read_input_MACS2_bed_consensus(source)
     elif peak_type == "SEACR" and not consensus:
-        peaks = read_input_SEACR(file_path)
+        peaks = read_input_SEACR(source)
     elif peak_type == "BED6" and not consensus:
-        peaks = read_input_BED6(file_path)
+        peaks = read_input_BED6(source)
     else:
         raise TypeError("Invalid peak type")
 
-    if "bed" in file_path:
-        peaks = peaks.with_columns(pl.col("start") + 1)
-        peaks = peaks.with_columns(pl.col("end") + 1)
+    peaks = edit_peaks(peaks, option, boundary, 1 if "bed" in file_path else 0)
+    if columns is not None:
+        peaks = peaks.select(columns)
 
-    peaks = edit_peaks(peaks, option, boundary)
     return peaks
 
 
-def read_input_MACS2_xls(file_path: str) -> pl.DataFrame:
+def iter_peaks(
+    file_path: str,
+    peak_type: str,
+    option: str,
+    boundary: int,
+    consensus: bool,
+    chunk_size: int,
+    columns: list = None,
+):
+    """
+    Read in peak data chunk_size peaks at a time. Each chunk is read exactly as
+    process_peaks reads a whole file, with the header lines of the format
+    repeated in front of it, so only one chunk is held in memory at a time.
+    Compressed peak files are decompressed as they are read.
+
+    Parameters:
+    file_path (str): Path to the peak file.
+    peak_type (str): Type of peak caller used to generate peak file (e.g. MACS2, SEACR, BED6).
+    option (str): Option for defining start and end positions of peaks.
+    boundary (int): Boundary for artificial peak boundary option. None if other options.
+    consensus (bool): Whether to use consensus peaks.
+    chunk_size (int): Number of peaks per chunk.
+    columns (list): Columns to keep, or None to keep all columns of the input file.
+                    Default None.
+
+    Returns:
+    chunks (generator): Generator of Polars LazyFrames with the peaks of each chunk.
+
+    Outputs:
+    None
+    """
+    format_path = strip_compression_suffix(file_path)
+    if peak_type == "MACS2" and "xls" in format_path and not consensus:
+        # 22 skipped lines and the column header, see read_input_MACS2_xls
+        num_header_lines = 23
+    elif peak_type == "MACS2" and "bed" in format_path and consensus:
+        # see read_input_MACS2_bed_consensus
+        num_header_lines = 24
+    else:
+        num_header_lines = 0
+
+    with open_peak_file(file_path) as f:
+        header = b"".join(itertools.islice(f, num_header_lines))
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            yield process_peaks(
+                file_path,
+                peak_type,
+                option,
+                boundary,
+                consensus,
+                io.BytesIO(header + b"".join(lines)),
+                columns,
+            )
+
+
+def read_peak_table(
+    source, has_header: bool = False, skip_rows: int = 0
+) -> pl.LazyFrame:
+    """
+    Scan a tab separated peak table. Uncompressed files and file-like objects are
+    scanned by Polars; compressed files are streamed through the PyArrow CSV
+    reader, which decompresses blocks while earlier blocks are being parsed.
+    Either way only the columns the query uses are parsed. Without a header, the
+    columns are named column_1, column_2, ...
+
+    Parameters:
+    source (str | file-like): Path to the peak file or file-like object.
+    has_header (bool): Whether the first line after skip_rows holds the column names.
+                       Default False.
+    skip_rows (int): Number of lines to skip at the start of the table. Default 0.
+
+    Returns:
+    peaks (pl.LazyFrame): Polars LazyFrame scanning the table.
+
+    Outputs:
+    None
+    """
+    compression = peak_compression(source) if isinstance(source, str) else None
+    if compression is None:
+        return pl.scan_csv(
+            source, has_header=has_header, separator="\t", skip_rows=skip_rows
+        )
+
+    def open_table(column_names=None, include_columns=None, column_types=None):
+        # With explicit column names, a header line is skipped like any other.
+        header_rows = int(has_header and column_names is not None)
+        return pcsv.open_csv(
+            pa.input_stream(source, compression=compression),
+            read_options=pcsv.ReadOptions(
+                skip_rows=skip_rows + header_rows,
+                column_names=column_names,
+                autogenerate_column_names=not has_header and column_names is None,
+            ),
+            parse_options=pcsv.ParseOptions(delimiter="\t"),
+            convert_options=pcsv.ConvertOptions(
+                include_columns=include_columns, column_types=column_types
+            ),
+        )
+
+    # Column types are inferred from the first block, as read_csv would.
+    with open_table() as reader:
+        schema = reader.schema
+    if not has_header:
+        schema = pa.schema(
+            [field.with_name(f"column_{i+1}") for i, field in enumerate(schema)]
+        )
+
+    def scan_table(with_columns, predicate, n_rows, batch_size):
+        with open_table(schema.names, with_columns, schema) as reader:
+            for batch in reader:
+                peaks = pl.from_arrow(pa.Table.from_batches([batch]))
+                if predicate is not None:
+                    peaks = peaks.filter(predicate)
+                if n_rows is not None:
+                    peaks = peaks.head(n_rows)
+                    n_rows -= peaks.height
+                yield peaks
+                if n_rows == 0:
+                    break
+
+    return register_io_source(
+        scan_table, schema=pl.from_arrow(schema.empty_table()).schema
+    )
+
+
+def peak_compression(file_path: str) -> str:
+    """
+    Detect the compression of a peak file from its first bytes.
+
+    Parameters:
+    file_path (str): Path to the peak file.
+
+    Returns:
+    compression (str): 'gzip' (also for bgzip), 'zstd', or None if the file is not
+                       compressed.
+
+    Outputs:
+    None
+    """
+    with open(file_path, "rb") as f:
+        magic = f.read(4)
+
+    if magic[:2] == b"\x1f\x8b":
+        return "gzip"
+    elif magic == b"\x28\xb5\x2f\xfd":
+        return "zstd"
+    else:
+        return None
+
+
+def strip_compression_suffix(file_path: str) -> str:
     """
-    Read in MACS2 peak data in Excel format.
+    Remove a compression suffix (.gz, .bgz, .zst or .zstd) from a peak file path.
 
     Parameters:
     file_path (str): Path to the peak file.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    file_path (str): Path without its compression suffix.
+
+    Outputs:
+    None
+    """
+    for suffix in COMPRESSION_SUFFIXES:
+        if file_path.endswith(suffix):
+            return file_path[: -len(suffix)]
+
+    return file_path
+
+
+def open_peak_file(file_path: str):
+    """
+    Open a peak file for reading bytes, decompressing it if it is compressed.
+
+    Parameters:
+    file_path (str): Path to the peak file.
+
+    Returns:
+    f (io.BufferedReader): Buffered binary file object over the (decompressed) data.
+
+    Outputs:
+    None
+    """
+    return io.BufferedReader(
+        pa.input_stream(file_path, compression=peak_compression(file_path))
+    )
+
+
+def read_input_MACS2_xls(file_path: str) -> pl.LazyFrame:
+    """
+    Scan MACS2 peak data in Excel format.
+
+    Parameters:
+    file_path (str): Path to the peak file.
+
+    Returns:
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
     None
     """
-    peaks = pl.read_csv(file_path, separator="\t", skip_rows=22)
+    peaks = read_peak_table(file_path, has_header=True, skip_rows=22)
     peaks = peaks.rename(
         {"-log10(pvalue)": "neg_log10_pvalue", "-log10(qvalue)": "neg_log10_qvalue"}
     )
@@ -82,15 +298,15 @@ def read_input_MACS2_xls(file_path: str) -> pl.DataFrame:
     return peaks
 
 
-def read_input_MACS2_bed(file_path: str) -> pl.DataFrame:
+def read_input_MACS2_bed(file_path: str) -> pl.LazyFrame:
     """
-    Read in MACS2 peak data in bed format.
+    Scan MACS2 peak data in bed format.
 
     Parameters:
     file_path (str): Path to the peak file.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
@@ -108,23 +324,23 @@ def read_input_MACS2_bed(file_path: str) -> pl.DataFrame:
         "qvalue",
         "peak",
     ]
-    peaks = pl.read_csv(file_path, has_header=False, separator="\t")
+    peaks = read_peak_table(file_path)
 
-    rename_columns = {f"column_{i+1}": col_names[i] for i in range(peaks.width)}
-    peaks = peaks.rename(dict(rename_columns))
+    rename_columns = {f"column_{i+1}": name for i, name in enumerate(col_names)}
+    peaks = peaks.rename(rename_columns, strict=False)
 
     return peaks
 
 
-def read_input_MACS2_bed_consensus(file_path: str) -> pl.DataFrame:
+def read_input_MACS2_bed_consensus(file_path: str) -> pl.LazyFrame:
     """
-    Read in MACS2 peak data in bed format.
+    Scan MACS2 peak data in bed format.
 
     Parameters:
     file_path (str): Path to the peak file.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
@@ -154,10 +370,10 @@ def read_input_MACS2_bed_consensus(file_path: str) -> pl.DataFrame:
         "avg_qvalue",
     ]
 
-    peaks = pl.read_csv(file_path, has_header=False, separator="\t", skip_rows=24)
+    peaks = read_peak_table(file_path, skip_rows=24)
 
-    rename_columns = {f"column_{i+1}": col_names[i] for i in range(peaks.width)}
-    peaks = peaks.rename(dict(rename_columns))
+    rename_columns = {f"column_{i+1}": name for i, name in enumerate(col_names)}
+    peaks = peaks.rename(rename_columns, strict=False)
 
     rename_name_column = {"peak_names": "name"}
     peaks = peaks.rename(rename_name_column)
@@ -165,63 +381,68 @@ def read_input_MACS2_bed_consensus(file_path: str) -> pl.DataFrame:
     return peaks
 
 
-def read_input_SEACR(file_path: str) -> pl.DataFrame:
+def read_input_SEACR(file_path: str) -> pl.LazyFrame:
     """
-    Read in SEACR peak data in bed format.
+    Scan SEACR peak data in bed format.
 
     Parameters:
     file_path (str): Path to the peak file.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
     None
     """
     col_names = ["chr", "start", "end", "name", "max_signal", "region"]
-    peaks = pl.read_csv(file_path, has_header=False, separator="\t")
+    peaks = read_peak_table(file_path)
 
-    rename_columns = {f"column_{i+1}": col_names[i] for i in range(peaks.width)}
-    peaks = peaks.rename(dict(rename_columns))
+    rename_columns = {f"column_{i+1}": name for i, name in enumerate(col_names)}
+    peaks = peaks.rename(rename_columns, strict=False)
 
     return peaks
 
 
-def read_input_BED6(file_path: str) -> pl.DataFrame:
+def read_input_BED6(file_path: str) -> pl.LazyFrame:
     """
-    Read in BED6 format peak data (chrom, start, end, name, score, strand).
+    Scan BED6 format peak data (chrom, start, end, name, score, strand).
 
     Parameters:
     file_path (str): Path to the peak file.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file.
 
     Outputs:
     None
     """
     col_names = ["chr", "start", "end", "name", "score", "strand"]
-    peaks = pl.read_csv(file_path, has_header=False, separator="\t")
+    peaks = read_peak_table(file_path)
 
-    rename_columns = {f"column_{i+1}": col_names[i] for i in range(min(peaks.width, 6))}
-    peaks = peaks.rename(dict(rename_columns))
+    rename_columns = {f"column_{i+1}": name for i, name in enumerate(col_names)}
+    peaks = peaks.rename(rename_columns, strict=False)
 
     return peaks
 
 
-def edit_peaks(peaks: pl.DataFrame, option: str, boundary: int) -> pl.DataFrame:
+def edit_peaks(
+    peaks: pl.LazyFrame, option: str, boundary: int, shift: int = 0
+) -> pl.LazyFrame:
     """
-    Edit peak start and end positions based on option.
+    Edit peak start and end positions based on option. The coordinate shift and the
+    edit are applied together in a single pass over the peaks.
 
     Parameters:
-    peaks (pl.DataFrame): Polars DataFrame containing relevant peak information.
+    peaks (pl.LazyFrame): Polars LazyFrame containing relevant peak information.
     option (str): Option for defining start and end positions of peaks.
     boundary (int): Boundary for artificial peak boundary option. None if other options.
+    shift (int): Offset added to native start and end positions (1 for bed files,
+                 which are 0-based). Default 0.
 
     Returns:
-    peaks (pl.DataFrame): Polars DataFrame containing all relevant peak data
+    peaks (pl.LazyFrame): Polars LazyFrame containing all relevant peak data
                           from the input file with edited start and end positions.
 
     Outputs:
@@ -229,35 +450,78 @@ def edit_peaks(peaks: pl.DataFrame, option: str, boundary: int) -> pl.DataFrame:
     """
 
     if option == "peak_summit":
-        peaks.drop_in_place("start")
-        peaks.with_columns((peaks.col("abs_summit")).alias("start"))
-        peaks.drop_in_place("end")
-        peaks.with_columns((peaks.col("abs_summit")).alias("end"))
+        start = pl.col("abs_summit")
+        end = pl.col("abs_summit")
     elif option == "artifical_peak_boundaries" and boundary is not None:
-        peaks.drop_in_place("start")
-        peaks.with_columns((peaks.col("abs_summit") - boundary).alias("start"))
-        peaks.drop_in_place("end")
-        peaks.with_columns((peaks.col("abs_summit") + boundary).alias("end"))
+        start = pl.col("abs_summit") - boundary
+        end = pl.col("abs_summit") + boundary
     elif option == "native_peak_boundaries":
-        pass
+        if shift == 0:
+            return peaks
+        start = pl.col("start") + shift
+        end = pl.col("end") + shift
     else:
         raise ValueError("Invalid peak start/end option")
 
-    return peaks
+    return peaks.with_columns(start.alias("start"), end.alias("end"))
 
 
 def process_genes(file_path: str, ref_dir: str) -> pl.DataFrame:
-    genes = pl.read_csv(file_path, has_header=False).to_numpy()[:, 0].tolist()
-    gene_df = pl.DataFrame()
-    for csv in os.listdir(os.path.join(ref_dir, "gene")):
-        cur = pl.read_csv(os.path.join(ref_dir, "gene", csv))
-        for gene in genes[:]:
-            if gene in cur.select(["gene_name"]).to_numpy():
-                gene_df = pl.concat([gene_df, cur.filter(pl.col("gene_name") == gene)])
-                genes.remove(gene)
-
-    if genes:
-        raise ValueError(genes[0] + " is not a valid gene.")
+    """
+    Look up the reference entries of a list of genes. The whole list is resolved
+    with a single join against the gene name index of the decomposed reference;
+    a gene found on several chromosomes is taken from the first one. Attribute
+    columns missing on some chromosomes are filled with nulls.
+
+    Parameters:
+    file_path (str): Path to a single column file of gene names with no header.
+    ref_dir (str): Directory containing decomposed reference data.
+
+    Returns:
+    gene_df (pl.DataFrame): Polars DataFrame containing the reference entries of the
+                            genes, with the gene_name column renamed to name.
+
+    Outputs:
+    None
+    """
+    genes = pl.read_csv(file_path, has_header=False, infer_schema=False).to_series(0)
+    queries = pl.DataFrame({"gene_name": genes}).with_row_index("query")
+    index = (
+        load_name_index(ref_dir, "gene", "gene_name")
+        .filter(pl.col("gene_name").is_in(genes))
+        .with_columns(pl.col(["gene_name", "chr"]).cast(pl.String))
+        .with_row_index("position")
+    )
+
+    missing = (
+        queries.join(index, on="gene_name", how="anti")
+        .get_column("gene_name")
+        .unique(maintain_order=True)
+        .to_list()
+    )
+    if len(missing) == 1:
+        raise ValueError(missing[0] + " is not a valid gene.")
+    elif missing:
+        raise ValueError(", ".join(missing) + " are not valid genes.")
+
+    matches = (
+        queries.join(index, on="gene_name", how="inner")
+        .filter(
+            pl.col("chr") == pl.col("chr").sort_by("position").first().over("query")
+        )
+        .with_columns(pl.col("position").min().over("chr").alias("chr_position"))
+        .sort(["chr_position", "query", "row"])
+    )
+
+    gene_df = pl.concat(
+        [
+            load_reference(ref_dir, "gene", chromosome)[
+                group.get_column("row").to_numpy()
+            ].with_columns(pl.col(pl.Categorical).cast(pl.String))
+            for (chromosome,), group in matches.group_by("chr", maintain_order=True)
+        ],
+        how="diagonal_relaxed",
+    )
 
     gene_df = gene_df.rename({"gene_name": "name"})
 
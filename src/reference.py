@@ -0,0 +1,828 @@
+# ------------------------------------------------------------------------------
+#                        __   _____                  __
+#      ____  ___  ____ _/ /__/ ___/_________  __  __/ /_
+#     / __ \/ _ \/ __ `/ //_/\__ \/ ___/ __ \/ / / / __/
+#    / /_/ /  __/ /_/ / ,<  ___/ / /__/ /_/ / /_/ / /_
+#   / .___/\___/\__,_/_/|_|/____/\___/\____/\__,_/\__/
+#  /_/
+#
+# Copyrigh 2025 GNU AFFERO GENERAL PUBLIC LICENSE
+# Alexander L. Lin, Lana A. Cartailler, Jean-Philippe Cartailler
+# https://github.com/vandydata/peakScout
+#
+# ------------------------------------------------------------------------------
+
+import polars as pl
+import numpy as np
+import os
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+
+# Preferred first: a reference directory may hold several formats, e.g. an
+# Arrow store next to a CSV export.
+REFERENCE_FORMATS = ["arrow", "parquet", "csv"]
+
+MANIFEST_NAME = "manifest.json"
+
+# Loaded references kept for long-lived callers, keyed by
+# (ref_dir, feature, chromosome, kind) in least recently used order. Each
+# entry holds the file signature (path, mtime, size) it was loaded from, the
+# DataFrame, end order array or interval index and its size in bytes.
+REFERENCE_CACHE = OrderedDict()
+REFERENCE_CACHE_LOCK = threading.Lock()
+REFERENCE_CACHE_STATS = {"hits": 0, "misses": 0, "stale": 0, "evictions": 0}
+REFERENCE_CACHE_SETTINGS = {
+    "max_bytes": int(
+        float(os.environ.get("PEAKSCOUT_REFERENCE_CACHE_MB", 2048)) * 2**20
+    )
+}
+
+
+def reference_path(
+    ref_dir: str, feature: str, chromosome: str, order: str, ref_format: str
+) -> str:
+    """
+    Build the path of one decomposed reference file.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    order (str): Column the file is sorted by, either 'start' or 'end'.
+    ref_format (str): Storage format, one of 'arrow', 'parquet' or 'csv'.
+
+    Returns:
+    path (str): Path of the form ref_dir/feature/chromosome_order.ref_format.
+
+    Outputs:
+    None
+    """
+    return os.path.join(ref_dir, feature, chromosome + "_" + order + "." + ref_format)
+
+
+def write_reference(
+    df: pl.DataFrame,
+    ref_dir: str,
+    feature: str,
+    chromosome: str,
+    order: str,
+    ref_format: str = "arrow",
+) -> str:
+    """
+    Write one decomposed reference file. Binary formats keep the column types
+    and store string columns dictionary-encoded; Arrow IPC files are written
+    uncompressed so that they can be memory-mapped when loaded.
+
+    Parameters:
+    df (pl.DataFrame): Polars DataFrame of features on one chromosome.
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    order (str): Column the DataFrame is sorted by, either 'start' or 'end'.
+    ref_format (str): Storage format, one of 'arrow', 'parquet' or 'csv'. Default 'arrow'.
+
+    Returns:
+    path (str): Path of the written file.
+
+    Outputs:
+    The reference file at ref_dir/feature/chromosome_order.ref_format.
+    """
+    path = reference_path(ref_dir, feature, chromosome, order, ref_format)
+
+    if ref_format == "csv":
+        return write_atomic(path, df.write_csv)
+
+    df = df.with_columns(pl.col(pl.String).cast(pl.Categorical))
+    if ref_format == "arrow":
+        return write_atomic(
+            path, lambda tmp: df.write_ipc(tmp, compression="uncompressed")
+        )
+    elif ref_format == "parquet":
+        return write_atomic(path, df.write_parquet)
+    else:
+        raise ValueError("Invalid reference format")
+
+
+def write_atomic(path: str, write) -> str:
+    """
+    Write a file atomically: the content is written to a temporary file next to
+    path, which then replaces path. Readers never see a partially written file,
+    and an interrupted write leaves any previous file in place.
+
+    Parameters:
+    path (str): Path of the file to write.
+    write (callable): Function that writes the content given a file path.
+
+    Returns:
+    path (str): Path of the written file.
+
+    Outputs:
+    The file at path.
+    """
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        write(tmp)
+        os.replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return path
+
+
+def find_reference(ref_dir: str, feature: str, chromosome: str, order: str) -> str:
+    """
+    Find the decomposed reference file for a chromosome, preferring binary
+    formats over CSV.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    order (str): Column the file is sorted by, either 'start' or 'end'.
+
+    Returns:
+    path (str): Path of the reference file.
+
+    Outputs:
+    None
+    """
+    for ref_format in REFERENCE_FORMATS:
+        path = reference_path(ref_dir, feature, chromosome, order, ref_format)
+        if os.path.exists(path):
+            return path
+
+    raise FileNotFoundError(
+        f"No {feature} reference for {chromosome} in {ref_dir} "
+        f"(looked for {chromosome}_{order}.{{{','.join(REFERENCE_FORMATS)}}})"
+    )
+
+
+def load_reference(
+    ref_dir: str,
+    feature: str,
+    chromosome: str,
+    order: str = "start",
+    use_cache: bool = True,
+) -> pl.DataFrame:
+    """
+    Load the decomposed reference of one feature type on one chromosome.
+    Arrow IPC and Parquet files are memory-mapped; CSV is parsed as before.
+    String columns of binary references stay dictionary-encoded (Categorical);
+    they are decoded only for the rows that end up in the output (see
+    take_features and process_genes). The features
+    are stored once in start order. Unless the reference was decomposed with a
+    separate end-sorted copy, the end-ordered view holds only the start and end
+    positions, gathered with the stored end order permutation (see
+    load_end_order); the nearest feature engines take that permutation directly
+    and map the hits back to the start-ordered rows.
+
+    Loaded references are kept in an in-process cache. A cached entry is reused
+    only while its file keeps the same modification time and size, and the
+    least recently used entries are evicted once the cache exceeds its memory
+    cap (see set_reference_cache_limit). The returned DataFrame may be shared
+    with other callers and must not be modified in place.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    order (str): Column the features are sorted by, either 'start' or 'end'. Default 'start'.
+    use_cache (bool): Whether to use the in-process reference cache. Default True.
+
+    Returns:
+    df (pl.DataFrame): Polars DataFrame of features on that chromosome.
+
+    Outputs:
+    None
+    """
+    if order == "end":
+        try:
+            path = find_reference(ref_dir, feature, chromosome, "end")
+        except FileNotFoundError:
+            starts = load_reference(ref_dir, feature, chromosome, "start", use_cache)
+            return starts.select(["start", "end"])[
+                np.asarray(load_end_order(ref_dir, feature, chromosome, use_cache))
+            ]
+    else:
+        path = find_reference(ref_dir, feature, chromosome, order)
+
+    return load_cached(
+        (os.path.abspath(ref_dir), feature, chromosome, order),
+        path,
+        read_reference,
+        use_cache,
+    )
+
+
+def load_end_order(
+    ref_dir: str, feature: str, chromosome: str, use_cache: bool = True
+) -> np.ndarray:
+    """
+    Load the end order permutation of one feature type on one chromosome: the
+    row indices of the start-ordered reference sorted by end position (ties
+    keep start order). The stored array is memory-mapped. References
+    decomposed with a separate end-sorted copy have no stored permutation,
+    so it is derived from the start-ordered rows instead.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    use_cache (bool): Whether to use the in-process reference cache. Default True.
+
+    Returns:
+    end_order (np.ndarray): NumPy int32 array of row indices in end order.
+
+    Outputs:
+    None
+    """
+    key = (os.path.abspath(ref_dir), feature, chromosome, "end_order")
+    path = end_order_path(ref_dir, feature, chromosome)
+    if os.path.exists(path):
+        return load_cached(key, path, read_end_order, use_cache)
+
+    return load_cached(
+        key,
+        find_reference(ref_dir, feature, chromosome, "start"),
+        lambda path: gen_end_order(read_reference(path)),
+        use_cache,
+    )
+
+
+def gen_end_order(df: pl.DataFrame) -> np.ndarray:
+    """
+    Generate the end order permutation of a start-ordered reference.
+
+    Parameters:
+    df (pl.DataFrame): Polars DataFrame of features sorted by start position.
+
+    Returns:
+    end_order (np.ndarray): NumPy int32 array of row indices sorted by end position,
+                            with ties kept in start order.
+
+    Outputs:
+    None
+    """
+    return np.argsort(df.get_column("end").to_numpy(), kind="stable").astype(np.int32)
+
+
+def build_interval_index(
+    starts: np.ndarray, ends: np.ndarray
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Build an interval index over the reference features of one chromosome: the
+    start-sorted start and end positions together with the running maximum of
+    the end positions. Because the running maximum never decreases, the first
+    feature that can reach a position is found with a single binary search.
+
+    Parameters:
+    starts (np.ndarray): NumPy array of start positions of reference features, sorted.
+    ends (np.ndarray): NumPy array of end positions of reference features, in start order.
+
+    Returns:
+    index (tuple): Tuple of the start positions, end positions and running maximum
+                   end positions of the reference features.
+
+    Outputs:
+    None
+    """
+    max_ends = np.maximum.accumulate(ends) if len(ends) else ends
+    return starts, ends, max_ends
+
+
+def load_interval_index(
+    ref_dir: str, feature: str, chromosome: str, use_cache: bool = True
+) -> tuple:
+    """
+    Load the interval index (see build_interval_index) of the decomposed
+    reference of one feature type on one chromosome. The index is kept in the
+    in-process reference cache next to the reference it is built from, so that
+    it is built once per reference rather than once per peak file.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+    use_cache (bool): Whether to use the in-process reference cache. Default True.
+
+    Returns:
+    index (tuple): Tuple of the int64 start positions, end positions and running
+                   maximum end positions of the features, in start order.
+
+    Outputs:
+    None
+    """
+
+    def build(path: str) -> tuple:
+        starts = load_reference(ref_dir, feature, chromosome, "start", use_cache)
+        return build_interval_index(
+            starts.get_column("start").to_numpy().astype(np.int64),
+            starts.get_column("end").to_numpy().astype(np.int64),
+        )
+
+    return load_cached(
+        (os.path.abspath(ref_dir), feature, chromosome, "interval_index"),
+        find_reference(ref_dir, feature, chromosome, "start"),
+        build,
+        use_cache,
+    )
+
+
+def end_order_path(ref_dir: str, feature: str, chromosome: str) -> str:
+    """
+    Build the path of the end order permutation of one decomposed reference.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+
+    Returns:
+    path (str): Path of the form ref_dir/feature/chromosome_end_order.npy.
+
+    Outputs:
+    None
+    """
+    return os.path.join(ref_dir, feature, chromosome + "_end_order.npy")
+
+
+def write_end_order(
+    end_order: np.ndarray, ref_dir: str, feature: str, chromosome: str
+) -> str:
+    """
+    Write the end order permutation of one decomposed reference.
+
+    Parameters:
+    end_order (np.ndarray): NumPy int32 array of row indices in end order.
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    chromosome (str): Chromosome name (e.g. chr1).
+
+    Returns:
+    path (str): Path of the written file.
+
+    Outputs:
+    The permutation at ref_dir/feature/chromosome_end_order.npy.
+    """
+    end_order = end_order.astype(np.int32)
+
+    def write(tmp):
+        with open(tmp, "wb") as f:
+            np.save(f, end_order)
+
+    return write_atomic(end_order_path(ref_dir, feature, chromosome), write)
+
+
+def read_end_order(path: str) -> np.ndarray:
+    """
+    Memory-map a stored end order permutation.
+
+    Parameters:
+    path (str): Path of the permutation file.
+
+    Returns:
+    end_order (np.ndarray): NumPy int32 array of row indices in end order.
+
+    Outputs:
+    None
+    """
+    return np.load(path, mmap_mode="r")
+
+
+def load_cached(key: tuple, path: str, loader, use_cache: bool = True):
+    """
+    Load a file through the reference cache.
+
+    Parameters:
+    key (tuple): Cache key of the form (ref_dir, feature, chromosome, kind).
+    path (str): Path of the file the value is loaded from.
+    loader (callable): Function that loads the value given path.
+    use_cache (bool): Whether to use the in-process reference cache. Default True.
+
+    Returns:
+    value (pl.DataFrame | np.ndarray | tuple): The loaded value.
+
+    Outputs:
+    None
+    """
+    if not use_cache:
+        return loader(path)
+
+    stat = os.stat(path)
+    signature = (path, stat.st_mtime_ns, stat.st_size)
+
+    with REFERENCE_CACHE_LOCK:
+        entry = REFERENCE_CACHE.get(key)
+        if entry is not None and entry[0] == signature:
+            REFERENCE_CACHE.move_to_end(key)
+            REFERENCE_CACHE_STATS["hits"] += 1
+            return entry[1]
+        REFERENCE_CACHE_STATS["misses"] += 1
+        if entry is not None:
+            REFERENCE_CACHE_STATS["stale"] += 1
+
+    value = loader(path)
+    if isinstance(value, np.ndarray):
+        size = value.nbytes
+    elif isinstance(value, tuple):
+        size = sum(array.nbytes for array in value)
+    else:
+        size = value.estimated_size()
+
+    with REFERENCE_CACHE_LOCK:
+        REFERENCE_CACHE[key] = (signature, value, size)
+        REFERENCE_CACHE.move_to_end(key)
+        evict_references(REFERENCE_CACHE_SETTINGS["max_bytes"])
+
+    return value
+
+
+def read_reference(path: str) -> pl.DataFrame:
+    """
+    Read one decomposed reference file from disk.
+
+    Parameters:
+    path (str): Path of the reference file.
+
+    Returns:
+    df (pl.DataFrame): Polars DataFrame of features on that chromosome.
+
+    Outputs:
+    None
+    """
+    if path.endswith(".arrow"):
+        return pl.read_ipc(path, memory_map=True)
+    elif path.endswith(".parquet"):
+        return pl.read_parquet(path, memory_map=True)
+    else:
+        return pl.read_csv(path)
+
+
+def reference_chromosomes(ref_dir: str, feature: str) -> list:
+    """
+    List the chromosomes with a decomposed reference for a feature type.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+
+    Returns:
+    chromosomes (list): Sorted list of chromosome names.
+
+    Outputs:
+    None
+    """
+    suffixes = tuple("_start." + ref_format for ref_format in REFERENCE_FORMATS)
+    chromosomes = {
+        file_name.rsplit("_start.", 1)[0]
+        for file_name in os.listdir(os.path.join(ref_dir, feature))
+        if file_name.endswith(suffixes)
+    }
+    return sorted(chromosomes)
+
+
+def preload_reference(ref_dir: str, feature: str) -> int:
+    """
+    Load the decomposed reference of a feature type on every chromosome, with its
+    end order permutations and interval indexes, into the in-process reference
+    cache, so that later callers (e.g. threads annotating several peak files)
+    share one copy.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+
+    Returns:
+    num_features (int): Number of features loaded.
+
+    Outputs:
+    None
+    """
+    num_features = 0
+    for chromosome in reference_chromosomes(ref_dir, feature):
+        num_features += load_reference(ref_dir, feature, chromosome).height
+        load_end_order(ref_dir, feature, chromosome)
+        load_interval_index(ref_dir, feature, chromosome)
+
+    return num_features
+
+
+def gen_name_index(references: dict, name_column: str = "gene_name") -> pl.DataFrame:
+    """
+    Generate the name index of a decomposed feature type: for every feature
+    name, the chromosome and row of the start-ordered reference it is stored at.
+
+    Parameters:
+    references (dict): Dictionary mapping chromosome name to the Polars DataFrame of
+                       features on it, sorted by start position.
+    name_column (str): Column holding the feature names. Default 'gene_name'.
+
+    Returns:
+    index (pl.DataFrame): Polars DataFrame with columns name_column, chr and row,
+                          ordered by chromosome name and then row.
+
+    Outputs:
+    None
+    """
+    return pl.concat(
+        [
+            references[chromosome]
+            .select(pl.col(name_column).cast(pl.String))
+            .with_row_index("row")
+            .with_columns(pl.lit(chromosome, dtype=pl.String).alias("chr"))
+            .select([name_column, "chr", "row"])
+            for chromosome in sorted(references)
+        ]
+    ).drop_nulls(name_column)
+
+
+def write_name_index(
+    index: pl.DataFrame,
+    ref_dir: str,
+    feature: str,
+    name_column: str = "gene_name",
+    ref_format: str = "arrow",
+) -> str:
+    """
+    Write the name index of a decomposed feature type.
+
+    Parameters:
+    index (pl.DataFrame): Polars DataFrame from gen_name_index.
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    name_column (str): Column holding the feature names. Default 'gene_name'.
+    ref_format (str): Storage format, one of 'arrow', 'parquet' or 'csv'. Default 'arrow'.
+
+    Returns:
+    path (str): Path of the written file.
+
+    Outputs:
+    The index at ref_dir/feature/name_column_index.ref_format.
+    """
+    return write_reference(index, ref_dir, feature, name_column, "index", ref_format)
+
+
+def load_name_index(
+    ref_dir: str,
+    feature: str,
+    name_column: str = "gene_name",
+    use_cache: bool = True,
+) -> pl.DataFrame:
+    """
+    Load the name index of a decomposed feature type (see gen_name_index).
+    References decomposed without an index have it built from the
+    chromosome files instead.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+    name_column (str): Column holding the feature names. Default 'gene_name'.
+    use_cache (bool): Whether to use the in-process reference cache. Default True.
+
+    Returns:
+    index (pl.DataFrame): Polars DataFrame with columns name_column, chr and row.
+
+    Outputs:
+    None
+    """
+    try:
+        path = find_reference(ref_dir, feature, name_column, "index")
+    except FileNotFoundError:
+        return gen_name_index(
+            {
+                chromosome: load_reference(
+                    ref_dir, feature, chromosome, "start", use_cache
+                )
+                for chromosome in reference_chromosomes(ref_dir, feature)
+            },
+            name_column,
+        )
+
+    return load_cached(
+        (os.path.abspath(ref_dir), feature, name_column, "index"),
+        path,
+        read_reference,
+        use_cache,
+    )
+
+
+def load_manifest(ref_dir: str) -> dict:
+    """
+    Load the manifest of a decomposed reference directory. The manifest records
+    the GTF the references were built from (path, SHA-256 checksum and feature
+    types), the decomposition parameters, and for each feature type the SHA-256
+    checksum of every output file, keyed by its path relative to ref_dir, and
+    the statistics of every chromosome (see gen_reference_stats).
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+
+    Returns:
+    manifest (dict): The manifest, or an empty dictionary if there is none.
+
+    Outputs:
+    None
+    """
+    path = os.path.join(ref_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(manifest: dict, ref_dir: str) -> str:
+    """
+    Write the manifest of a decomposed reference directory (see load_manifest).
+
+    Parameters:
+    manifest (dict): The manifest.
+    ref_dir (str): Directory containing decomposed reference data.
+
+    Returns:
+    path (str): Path of the written manifest.
+
+    Outputs:
+    The manifest at ref_dir/manifest.json.
+    """
+
+    def write(tmp):
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    return write_atomic(os.path.join(ref_dir, MANIFEST_NAME), write)
+
+
+def outputs_up_to_date(ref_dir: str, outputs: dict) -> bool:
+    """
+    Check that the output files recorded in a manifest exist and are unchanged.
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    outputs (dict): Dictionary mapping file path relative to ref_dir to its SHA-256 checksum.
+
+    Returns:
+    up_to_date (bool): Whether every file exists with the recorded checksum.
+
+    Outputs:
+    None
+    """
+    for name, sha256 in outputs.items():
+        path = os.path.join(ref_dir, name)
+        if not os.path.exists(path) or file_sha256(path) != sha256:
+            return False
+
+    return True
+
+
+def gen_reference_stats(df: pl.DataFrame) -> dict:
+    """
+    Generate the statistics of the features of one type on one chromosome.
+
+    Parameters:
+    df (pl.DataFrame): Polars DataFrame of features on one chromosome.
+
+    Returns:
+    stats (dict): Dictionary with the number of features (count), the length
+                  (end - start) of the longest feature (max_length), the smallest
+                  start position (min_start) and the largest end position (max_end).
+
+    Outputs:
+    None
+    """
+    stats = df.select(
+        pl.len().alias("count"),
+        (pl.col("end") - pl.col("start")).max().alias("max_length"),
+        pl.col("start").min().alias("min_start"),
+        pl.col("end").max().alias("max_end"),
+    ).row(0, named=True)
+
+    return {
+        name: int(value) if value is not None else None for name, value in stats.items()
+    }
+
+
+def load_reference_stats(ref_dir: str, feature: str) -> dict:
+    """
+    Load the per-chromosome statistics of a decomposed feature type from the
+    manifest (see gen_reference_stats).
+
+    Parameters:
+    ref_dir (str): Directory containing decomposed reference data.
+    feature (str): Feature type (i.e. gene, CDS, exon, etc.).
+
+    Returns:
+    stats (dict): Dictionary mapping chromosome to its statistics, or None if the
+                  manifest has no statistics for the feature type.
+
+    Outputs:
+    None
+    """
+    return load_manifest(ref_dir).get("features", {}).get(feature, {}).get("stats")
+
+
+def file_sha256(path: str) -> str:
+    """
+    Compute the SHA-256 checksum of a file.
+
+    Parameters:
+    path (str): Path of the file.
+
+    Returns:
+    sha256 (str): Hexadecimal SHA-256 checksum of the file contents.
+
+    Outputs:
+    None
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def evict_references(max_bytes: int) -> None:
+    """
+    Evict least recently used references until the cache fits in max_bytes.
+    The caller must hold REFERENCE_CACHE_LOCK.
+
+    Parameters:
+    max_bytes (int): Memory cap of the cache in bytes.
+
+    Returns:
+    None
+
+    Outputs:
+    Removes entries from REFERENCE_CACHE.
+    """
+    total = sum(entry[2] for entry in REFERENCE_CACHE.values())
+    while REFERENCE_CACHE and total > max_bytes:
+        _, entry = REFERENCE_CACHE.popitem(last=False)
+        total -= entry[2]
+        REFERENCE_CACHE_STATS["evictions"] += 1
+
+
+def set_reference_cache_limit(max_bytes: int) -> None:
+    """
+    Set the memory cap of the reference cache, evicting references if needed.
+    The default cap is 2 GiB, or PEAKSCOUT_REFERENCE_CACHE_MB megabytes if that
+    environment variable is set. A cap of 0 disables caching.
+
+    Parameters:
+    max_bytes (int): Memory cap of the cache in bytes.
+
+    Returns:
+    None
+
+    Outputs:
+    None
+    """
+    with REFERENCE_CACHE_LOCK:
+        REFERENCE_CACHE_SETTINGS["max_bytes"] = max_bytes
+        evict_references(max_bytes)
+
+
+def clear_reference_cache() -> None:
+    """
+    Remove every reference from the cache and reset its statistics.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+
+    Outputs:
+    None
+    """
+    with REFERENCE_CACHE_LOCK:
+        REFERENCE_CACHE.clear()
+        for stat in REFERENCE_CACHE_STATS:
+            REFERENCE_CACHE_STATS[stat] = 0
+
+
+def reference_cache_stats() -> dict:
+    """
+    Report the hit/miss statistics and memory use of the reference cache.
+
+    Parameters:
+    None
+
+    Returns:
+    stats (dict): Dictionary with the number of hits, misses, stale reloads and
+                  evictions, the number of cached entries, the cached bytes and
+                  the memory cap in bytes.
+
+    Outputs:
+    None
+    """
+    with REFERENCE_CACHE_LOCK:
+        stats = dict(REFERENCE_CACHE_STATS)
+        stats["entries"] = len(REFERENCE_CACHE)
+        stats["bytes"] = sum(entry[2] for entry in REFERENCE_CACHE.values())
+        stats["max_bytes"] = REFERENCE_CACHE_SETTINGS["max_bytes"]
+    return stats
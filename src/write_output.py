@@ -12,19 +12,36 @@
 #
 # ------------------------------------------------------------------------------
 
-import pandas as pd
+import polars as pl
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+from concurrent.futures import ThreadPoolExecutor
+from openpyxl import Workbook
+from openpyxl.formatting.rule import FormulaRule
 from openpyxl.styles import PatternFill
 from openpyxl.worksheet.filters import FilterColumn, Filters
 from openpyxl.utils import get_column_letter
+from process_features import fill_missing_features
 
+OUTPUT_TYPES = ["csv", "xlsx", "csv.gz", "csv.zst", "parquet", "arrow"]
+CSV_COMPRESSION = {"csv": None, "csv.gz": "gzip", "csv.zst": "zstd"}
+CATEGORICAL_COLUMNS = ["chr", "strand"]
+# Output types that are written incrementally by write_output_stream.
+STREAM_OUTPUT_TYPES = ["csv", "csv.gz", "csv.zst", "parquet"]
+EXCEL_MAX_ROWS = 1048576
+EXCEL_WIDTH_SAMPLE = 1000
 
-def write_to_excel(output: pd.DataFrame, output_name: str, out_dir: str) -> None:
+
+def write_to_excel(output: pl.DataFrame, output_name: str, out_dir: str) -> None:
     """
-    Write output Pandas DataFrame to an Excel sheet
+    Write output Polars DataFrame to an Excel sheet. Rows are streamed to the file
+    in write-only mode; alternate rows are banded by a single conditional format
+    rule and column widths are measured on a sample of rows. Output with more
+    rows than an Excel sheet holds is split into one sheet per chromosome.
 
     Parameters:
-    output (pd.DataFrame): Pandas DataFrame containing peak data, the nearest k genes for each peak,
+    output (pl.DataFrame): Polars DataFrame containing peak data, the nearest k genes for each peak,
                            and the distance between those genes and the peak.
     output_name (str): Name for output file.
     out_dir (str): Directory to output file.
@@ -40,72 +57,286 @@ def write_to_excel(output: pd.DataFrame, output_name: str, out_dir: str) -> None
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
-    with pd.ExcelWriter(
-        os.path.join(out_dir, output_name) + ".xlsx", engine="openpyxl"
-    ) as writer:
-
-        output.to_excel(writer, sheet_name="Sheet1", index=False)
+    widths = excel_column_widths(output)
+    workbook = Workbook(write_only=True)
 
-        workbook = writer.book
-        worksheet = writer.sheets["Sheet1"]
+    for title, rows in excel_sheets(output).items():
+        worksheet = workbook.create_sheet(title)
+        for col_num, width in enumerate(widths, start=1):
+            worksheet.column_dimensions[get_column_letter(col_num)].width = width
 
-        for row_num in range(2, len(output) + 2):
-            if row_num % 2 == 0:
-                for col_num in range(1, output.shape[1] + 1):
-                    cell = worksheet.cell(row=row_num, column=col_num)
-                    cell.fill = PatternFill(
+        if rows.height > 0:
+            last_col = get_column_letter(max(output.width, 1))
+            worksheet.conditional_formatting.add(
+                f"A2:{last_col}{rows.height + 1}",
+                FormulaRule(
+                    formula=["MOD(ROW(),2)=0"],
+                    fill=PatternFill(
                         start_color="E6E6E6", end_color="E6E6E6", fill_type="solid"
-                    )
-            else:
-                for col_num in range(1, output.shape[1] + 1):
-                    cell = worksheet.cell(row=row_num, column=col_num)
-                    cell.fill = PatternFill(
-                        start_color="FFFFFF", end_color="FFFFFF", fill_type="solid"
-                    )
-
-        for column in worksheet.columns:
-            max_length = 0
-            column = [cell for cell in column]
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = max_length + 2
-            worksheet.column_dimensions[get_column_letter(column[0].column)].width = (
-                adjusted_width
+                    ),
+                ),
             )
 
-        chr_col_idx = None
-        for idx, cell in enumerate(worksheet[1], start=1):
-            if cell.value == "chr":
-                chr_col_idx = idx
-                break
-
-        if chr_col_idx is not None:
+        if "chr" in output.columns:
+            chr_col_idx = output.columns.index("chr") + 1
             col_letter = get_column_letter(chr_col_idx)
 
-            unique_chr_values = output["chr"].unique()
+            unique_chr_values = rows.get_column("chr").unique(maintain_order=True)
 
             filters = worksheet.auto_filter
-            filters.ref = f"{col_letter}1:{col_letter}{len(output) + 1}"
+            filters.ref = f"{col_letter}1:{col_letter}{rows.height + 1}"
             col = FilterColumn(colId=chr_col_idx - 1)
-            col.filters = Filters(filter=unique_chr_values.tolist())
+            col.filters = Filters(filter=[str(value) for value in unique_chr_values])
             filters.filterColumn.append(col)
 
-        workbook.save(os.path.join(out_dir, output_name) + ".xlsx")
+        worksheet.append(output.columns)
+        for row in rows.iter_rows():
+            worksheet.append(row)
+
+    workbook.save(os.path.join(out_dir, output_name) + ".xlsx")
+
+
+def excel_sheets(output: pl.DataFrame) -> dict:
+    """
+    Assign the rows of the output to Excel sheets. Output that fits in one sheet is
+    written to Sheet1; otherwise every chromosome gets its own sheet, itself split
+    into numbered sheets if it has more rows than a sheet holds.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing the output rows.
+
+    Returns:
+    sheets (dict): Dictionary mapping sheet title to the Polars DataFrame of its rows.
+
+    Outputs:
+    None
+    """
+    max_rows = EXCEL_MAX_ROWS - 1  # the header takes the first row
+    if output.height <= max_rows or "chr" not in output.columns:
+        return {
+            ("Sheet1" if offset == 0 else f"Sheet{offset // max_rows + 1}"): (
+                output.slice(offset, max_rows)
+            )
+            for offset in range(0, max(output.height, 1), max_rows)
+        }
+
+    sheets = {}
+    for (chromosome,), rows in output.partition_by(
+        "chr", maintain_order=True, as_dict=True
+    ).items():
+        # Sheet titles are limited to 31 characters and may not contain []:*?/\
+        title = "".join(c if c not in "[]:*?/\\" else "_" for c in str(chromosome))
+        title = title[:27]
+        for offset in range(0, rows.height, max_rows):
+            part = title if offset == 0 else f"{title}_{offset // max_rows + 1}"
+            sheets[part] = rows.slice(offset, max_rows)
+
+    return sheets
+
+
+def excel_column_widths(output: pl.DataFrame) -> list:
+    """
+    Determine Excel column widths from the header and an evenly spaced sample of
+    at most EXCEL_WIDTH_SAMPLE rows of the output.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing the output rows.
+
+    Returns:
+    widths (list): Width of every column of the output.
+
+    Outputs:
+    None
+    """
+    if output.width == 0:
+        return []
+
+    sample = output.gather_every(max(1, output.height // EXCEL_WIDTH_SAMPLE))
+    lengths = sample.select(pl.all().cast(pl.String).str.len_chars().max()).row(0)
 
+    return [
+        max(len(str(column)), length or 0) + 2
+        for column, length in zip(output.columns, lengths)
+    ]
 
-def write_to_csv(output: pd.DataFrame, output_name: str, out_dir: str) -> None:
+
+def write_output(
+    output: pl.DataFrame,
+    output_name: str,
+    out_dir: str,
+    output_type: str,
+    append: bool = False,
+    layout: str = "wide",
+) -> None:
     """
-    Write output Pandas DataFrame to an CSV file
+    Write output Polars DataFrame in the given output type. Text outputs (csv,
+    compressed csv and xlsx) show features that could not be found as N/A in the
+    wide layout and leave them empty in the long layout; binary outputs (parquet
+    and arrow) keep them null, with integer distance columns and
+    dictionary-encoded categorical columns.
 
     Parameters:
-    output (pd.DataFrame): Pandas DataFrame containing peak data, the nearest k genes for each peak,
+    output (pl.DataFrame): Polars DataFrame containing peak data, the nearest k genes for each peak,
                            and the distance between those genes and the peak.
     output_name (str): Name for output file.
     out_dir (str): Directory to output file.
+    output_type (str): Output type, one of OUTPUT_TYPES.
+    append (bool): Whether to append the rows, without a header, to the CSV file
+                   written by a previous call. Only for csv output types. Default False.
+    layout (str): Layout of the output, 'wide' or 'long' (see gen_return_roi). Default 'wide'.
+
+    Returns:
+    None
+
+    Outputs:
+    File containing peak data, the nearest k genes for each peak, and the distance
+    between those genes and the peak.
+    """
+    if output_type not in OUTPUT_TYPES:
+        raise ValueError("Invalid output type")
+    if append and output_type not in CSV_COMPRESSION:
+        raise ValueError(f"Cannot append to {output_type} output")
+
+    if output_type == "parquet":
+        write_to_parquet(output, output_name, out_dir)
+        return
+    if output_type == "arrow":
+        write_to_arrow(output, output_name, out_dir)
+        return
+
+    if layout == "wide":
+        output = fill_missing_features(output)
+    if output_type == "xlsx":
+        write_to_excel(output, output_name, out_dir)
+    else:
+        write_to_csv(
+            output,
+            output_name,
+            out_dir,
+            append,
+            CSV_COMPRESSION[output_type],
+        )
+
+
+def write_output_stream(
+    outputs,
+    output_name: str,
+    out_dir: str,
+    output_type: str,
+    append: bool = False,
+    layout: str = "wide",
+) -> int:
+    """
+    Write output Polars DataFrames, such as the results of each chromosome, to one
+    output file as they are produced. For the STREAM_OUTPUT_TYPES each frame is
+    written on a background thread while the next one is computed, so that at most
+    two frames are held at once. Arrow IPC files cannot change their dictionaries
+    between batches and Excel sheets are split on the whole output, so for those
+    the frames are gathered and written with write_output.
+
+    Parameters:
+    outputs (iterable): Polars DataFrames with the same columns, in output order.
+                        None entries and empty frames are skipped.
+    output_name (str): Name for output file.
+    out_dir (str): Directory to output file.
+    output_type (str): Output type, one of OUTPUT_TYPES.
+    append (bool): Whether to append the rows, without a header, to the CSV file
+                   written by a previous call. Only for csv output types. Default False.
+    layout (str): Layout of the output, 'wide' or 'long' (see gen_return_roi). Default 'wide'.
+
+    Returns:
+    num_rows (int): Number of rows written.
+
+    Outputs:
+    File containing peak data, the nearest k genes for each peak, and the distance
+    between those genes and the peak.
+    """
+    if output_type not in OUTPUT_TYPES:
+        raise ValueError("Invalid output type")
+    if append and output_type not in CSV_COMPRESSION:
+        raise ValueError(f"Cannot append to {output_type} output")
+
+    if output_type not in STREAM_OUTPUT_TYPES:
+        frames = [output for output in outputs if output is not None]
+        output = pl.concat(frames) if frames else pl.DataFrame()
+        write_output(output, output_name, out_dir, output_type, append, layout)
+        return output.height
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    path = os.path.join(out_dir, output_name) + "." + output_type
+    num_rows = 0
+    written = None
+    empty = pl.DataFrame()
+    with open(path, "ab" if append else "wb") as f, ThreadPoolExecutor(
+        max_workers=1
+    ) as writer:
+        if output_type == "parquet":
+            sink = None
+        elif CSV_COMPRESSION[output_type] is None:
+            sink = f
+        else:
+            # Appending starts a new gzip member or zstd frame, which readers concatenate.
+            sink = pa.CompressedOutputStream(f, CSV_COMPRESSION[output_type])
+
+        def write(output: pl.DataFrame, include_header: bool) -> None:
+            nonlocal sink
+            if output_type != "parquet":
+                if layout == "wide":
+                    output = fill_missing_features(output)
+                output.write_csv(sink, include_header=include_header)
+                return
+            table = encode_categories(output).to_arrow()
+            if sink is None:
+                sink = pq.ParquetWriter(f, table.schema, compression="zstd")
+            sink.write_table(table.cast(sink.schema))
+
+        try:
+            for output in outputs:
+                if output is None:
+                    continue
+                if output.height == 0:
+                    empty = output
+                    continue
+                # The frame belongs to the writer thread once submitted.
+                num_rows += output.height
+                if written is not None:
+                    written.result()
+                written = writer.submit(write, output, written is None and not append)
+
+            if written is not None:
+                written.result()
+        finally:
+            if sink is not None and sink is not f:
+                sink.close()
+
+    if written is None:
+        # Write the columns of an empty output, as write_output would.
+        write_output(empty, output_name, out_dir, output_type, append, layout)
+
+    return num_rows
+
+
+def write_to_csv(
+    output: pl.DataFrame,
+    output_name: str,
+    out_dir: str,
+    append: bool = False,
+    compression: str = None,
+) -> None:
+    """
+    Write output Polars DataFrame to an CSV file
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing peak data, the nearest k genes for each peak,
+                           and the distance between those genes and the peak.
+    output_name (str): Name for output file.
+    out_dir (str): Directory to output file.
+    append (bool): Whether to append the rows, without a header, to the CSV file
+                   written by a previous call. Default False.
+    compression (str): Compress the file with 'gzip' (.csv.gz) or 'zstd' (.csv.zst),
+                       or None for plain CSV. Default None.
 
     Returns:
     None
@@ -118,4 +349,91 @@ def write_to_csv(output: pd.DataFrame, output_name: str, out_dir: str) -> None:
     if not os.path.exists(out_dir):
         os.mkdir(out_dir)
 
-    output.to_csv(os.path.join(out_dir, output_name) + ".csv", index=False)
+    if compression is None:
+        with open(
+            os.path.join(out_dir, output_name) + ".csv", "ab" if append else "wb"
+        ) as f:
+            output.write_csv(f, include_header=not append)
+        return
+
+    suffix = {"gzip": ".csv.gz", "zstd": ".csv.zst"}[compression]
+    # Appending starts a new gzip member or zstd frame, which readers concatenate.
+    with open(
+        os.path.join(out_dir, output_name) + suffix, "ab" if append else "wb"
+    ) as f:
+        with pa.CompressedOutputStream(f, compression) as stream:
+            output.write_csv(stream, include_header=not append)
+
+
+def write_to_parquet(output: pl.DataFrame, output_name: str, out_dir: str) -> None:
+    """
+    Write output Polars DataFrame to a zstd compressed Parquet file.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing peak data, the nearest k genes for each peak,
+                           and the distance between those genes and the peak.
+    output_name (str): Name for output file.
+    out_dir (str): Directory to output file.
+
+    Returns:
+    None
+
+    Outputs:
+    Parquet file containing peak data, the nearest k genes for each peak, and the distance
+    between those genes and the peak.
+    """
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    encode_categories(output).write_parquet(
+        os.path.join(out_dir, output_name) + ".parquet", compression="zstd"
+    )
+
+
+def write_to_arrow(output: pl.DataFrame, output_name: str, out_dir: str) -> None:
+    """
+    Write output Polars DataFrame to an uncompressed Arrow IPC file, which readers
+    can memory-map instead of parsing.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing peak data, the nearest k genes for each peak,
+                           and the distance between those genes and the peak.
+    output_name (str): Name for output file.
+    out_dir (str): Directory to output file.
+
+    Returns:
+    None
+
+    Outputs:
+    Arrow IPC file containing peak data, the nearest k genes for each peak, and the distance
+    between those genes and the peak.
+    """
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+
+    encode_categories(output).write_ipc(
+        os.path.join(out_dir, output_name) + ".arrow", compression="uncompressed"
+    )
+
+
+def encode_categories(output: pl.DataFrame) -> pl.DataFrame:
+    """
+    Dictionary-encode the columns of the output with few distinct values: the
+    chromosome, the strand and the gene types of the nearest genes.
+
+    Parameters:
+    output (pl.DataFrame): Polars DataFrame containing the output rows.
+
+    Returns:
+    output (pl.DataFrame): Polars DataFrame with those columns cast to Categorical.
+
+    Outputs:
+    None
+    """
+    return output.with_columns(
+        pl.col(col).cast(pl.String).cast(pl.Categorical)
+        for col in output.columns
+        if col in CATEGORICAL_COLUMNS or col.endswith("_gene_type")
+    )
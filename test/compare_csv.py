@@ -1,29 +1,34 @@
 import csv
+import gzip
+import io
 import argparse
+import polars as pl
+import pyarrow as pa
 
 
 def main(args):
     actual = args.actual
     expected = args.expected
+    ordered = args.ordered
 
-    compare_csv_files(actual, expected)
+    compare_csv_files(actual, expected, ordered)
 
 
-def compare_csv_files(file1, file2):
-    with open(file1, "r") as f1, open(file2, "r") as f2:
-        reader1 = csv.reader(f1)
-        reader2 = csv.reader(f2)
-
-        rows1 = list(reader1)
-        rows2 = list(reader2)
+def compare_csv_files(file1, file2, ordered=False):
+    rows1 = read_rows(file1)
+    rows2 = read_rows(file2)
 
     headers1 = rows1[0]
     headers2 = rows2[0]
     if headers1 != headers2:
         raise Exception("Headers are different")
 
-    rows1 = set(tuple(row) for row in rows1[1:])
-    rows2 = set(tuple(row) for row in rows2[1:])
+    if ordered:
+        rows1 = rows1[1:]
+        rows2 = rows2[1:]
+    else:
+        rows1 = set(tuple(row) for row in rows1[1:])
+        rows2 = set(tuple(row) for row in rows2[1:])
 
     if rows1 == rows2:
         return True, "Files are identical"
@@ -31,11 +36,38 @@ def compare_csv_files(file1, file2):
         raise Exception("CSV files different")
 
 
+def read_rows(file):
+    # Binary outputs are compared as the csv polars writes for them.
+    if file.endswith(".parquet"):
+        text = pl.read_parquet(file).write_csv()
+    elif file.endswith(".arrow"):
+        text = pl.read_ipc(file).write_csv()
+    elif file.endswith(".gz"):
+        with gzip.open(file, "rt") as f:
+            text = f.read()
+    elif file.endswith(".zst"):
+        with pa.input_stream(file, compression="zstd") as f:
+            text = f.read().decode()
+    else:
+        with open(file, "r") as f:
+            text = f.read()
+
+    return list(csv.reader(io.StringIO(text)))
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="peakScount: find nearest features")
 
-    parser.add_argument("--actual", "--a", type=str, help="Path to actual csv")
+    parser.add_argument(
+        "--actual",
+        "--a",
+        type=str,
+        help="Path to actual csv, csv.gz, csv.zst, parquet or arrow",
+    )
     parser.add_argument("--expected", "--e", type=str, help="Path to expected csv")
+    parser.add_argument(
+        "--ordered", action="store_true", help="Also compare the order of the rows"
+    )
 
     args = parser.parse_args()
 
@@ -0,0 +1,68 @@
+import argparse
+from openpyxl import load_workbook
+from compare_csv import read_rows
+
+
+def main(args):
+    actual = args.actual
+    expected = args.expected
+    sheets = args.sheets
+
+    compare_xlsx_csv(actual, expected, sheets)
+
+
+def compare_xlsx_csv(xlsx_file, csv_file, sheets=None):
+    workbook = load_workbook(xlsx_file)
+    expected = read_rows(csv_file)
+
+    if sheets is not None and workbook.sheetnames != sheets:
+        raise Exception(f"Sheets are {workbook.sheetnames}, expected {sheets}")
+
+    rows = []
+    for worksheet in workbook.worksheets:
+        values = [
+            ["" if value is None else str(value) for value in row]
+            for row in worksheet.iter_rows(values_only=True)
+        ]
+        if values[0] != expected[0]:
+            raise Exception(f"Headers of sheet {worksheet.title} are different")
+        rows += values[1:]
+
+        for col_num, column in enumerate(expected[0], start=1):
+            width = worksheet.column_dimensions[
+                worksheet.cell(1, col_num).column_letter
+            ].width
+            if width is None or width < len(column):
+                raise Exception(
+                    f"Column {column} of sheet {worksheet.title} is too narrow"
+                )
+
+        formulas = [
+            formula
+            for rules in worksheet.conditional_formatting
+            for rule in rules.rules
+            for formula in rule.formula
+        ]
+        if len(values) > 1 and formulas != ["MOD(ROW(),2)=0"]:
+            raise Exception(f"Rows of sheet {worksheet.title} are not banded")
+
+    if len(rows) != len(expected) - 1:
+        raise Exception("Number of rows is different")
+    if set(tuple(row) for row in rows) != set(tuple(row) for row in expected[1:]):
+        raise Exception("Excel and CSV files different")
+
+    return True, "Files are identical"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="peakScount: find nearest features")
+
+    parser.add_argument("--actual", "--a", type=str, help="Path to actual xlsx")
+    parser.add_argument("--expected", "--e", type=str, help="Path to expected csv")
+    parser.add_argument(
+        "--sheets", type=str, nargs="+", default=None, help="Expected sheet titles"
+    )
+
+    args = parser.parse_args()
+
+    main(args)
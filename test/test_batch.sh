@@ -0,0 +1,30 @@
+#! /bin/bash
+
+set -e
+
+# Peak files given directly are written under their own names, and those of
+# the manifest under the names it lists.
+peakScout batch \
+    --peak_files test/test_MACS2.bed test/test_MACS2_chr2_first.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --workers 2 \
+    --ref_dir test/test-reference/test \
+    --o test/results/ \
+    --output_type csv
+
+peakScout batch \
+    --manifest test/test_batch_manifest.txt \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --ref_dir test/test-reference/test \
+    --o test/results/ \
+    --output_type csv
+
+for output_name in test_MACS2 test_MACS2_chr2_first test_batch_manifest_MACS2 test_batch_manifest_MACS2_chr2_first; do
+    python3 test/compare_csv.py \
+        --a test/results/$output_name.csv \
+        --e test/test_peak2gene_MACS2_expected_results.csv
+done
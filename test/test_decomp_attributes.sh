@@ -0,0 +1,23 @@
+#! /bin/bash
+
+set -e
+
+# Keeping only the attributes read when annotating returns the same features.
+peakScout decompose \
+    --ref_dir test/results/test-reference-attributes \
+    --gtf_ref test/test-reference/test/test.gtf \
+    --attributes annotation
+
+peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --ref_dir test/results/test-reference-attributes \
+    --output_name test_decomp_attributes \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_decomp_attributes.csv \
+    --e test/test_peak2gene_MACS2_expected_results.csv
@@ -0,0 +1,41 @@
+#! /bin/bash
+
+set -e
+
+# Decomposing only genes is enough to annotate peaks, and a second build of
+# the same features is skipped.
+for build in 1 2; do
+    log=$(peakScout decompose \
+        --ref_dir test/results/test-reference-features \
+        --gtf_ref test/test-reference/test/test.gtf \
+        --features gene)
+    echo "$log"
+done
+echo "$log" | grep -q "is up to date"
+
+peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --ref_dir test/results/test-reference-features \
+    --output_name test_decomp_features \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_decomp_features.csv \
+    --e test/test_peak2gene_MACS2_expected_results.csv
+
+# After the GTF changes, rebuilding only exons removes the genes of the
+# previous GTF instead of leaving them to be read.
+awk 'BEGIN { FS = OFS = "\t" } /^#/ { next } { print; $3 = "exon"; print }' \
+    test/test-reference/test/test.gtf > test/results/test_decomp_features_exon.gtf
+
+peakScout decompose \
+    --ref_dir test/results/test-reference-features \
+    --gtf_ref test/results/test_decomp_features_exon.gtf \
+    --features exon
+
+test -e test/results/test-reference-features/exon/chr1_start.arrow
+test ! -e test/results/test-reference-features/gene
@@ -0,0 +1,18 @@
+#! /bin/bash
+
+# The test peaks are far fewer than MIN_WORKER_PEAKS, so it is lifted to run
+# them on the worker processes.
+PEAKSCOUT_MIN_WORKER_PEAKS=0 peakScout gene2peak \
+    --gene_file test/test_genes.txt \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --k 3 \
+    --workers 2 \
+    --ref_dir test/test-reference/test \
+    --output_name test_gene2peak_MACS2_workers \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_gene2peak_MACS2_workers.csv \
+    --e test/test_gene2peak_MACS2_expected_results.csv
@@ -0,0 +1,17 @@
+#! /bin/bash
+
+# Every feature of the wide MACS2 expected results, one row per rank.
+peakScout gene2peak \
+    --gene_file test/test_genes.txt \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --k 3 \
+    --layout long \
+    --ref_dir test/test-reference/test \
+    --output_name test_gene2peak_layout_long \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_gene2peak_layout_long.csv \
+    --e test/test_gene2peak_layout_long_expected_results.csv
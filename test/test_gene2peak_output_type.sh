@@ -0,0 +1,20 @@
+#! /bin/bash
+
+set -e
+
+# Every output type holds the same rows as the csv output.
+for output_type in csv.gz csv.zst parquet arrow; do
+    peakScout gene2peak \
+        --gene_file test/test_genes.txt \
+        --peak_file test/test_MACS2.bed \
+        --peak_type MACS2 \
+        --k 3 \
+        --ref_dir test/test-reference/test \
+        --output_name test_gene2peak_output_type \
+        --o test/results/ \
+        --output_type $output_type
+
+    python3 test/compare_csv.py \
+        --a test/results/test_gene2peak_output_type.$output_type \
+        --e test/test_gene2peak_MACS2_expected_results.csv
+done
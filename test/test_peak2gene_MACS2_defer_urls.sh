@@ -0,0 +1,16 @@
+#! /bin/bash
+
+peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --defer_urls \
+    --ref_dir test/test-reference/test \
+    --output_name test_peak2gene_MACS2_defer_urls \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_peak2gene_MACS2_defer_urls.csv \
+    --e test/test_peak2gene_MACS2_expected_results.csv
@@ -0,0 +1,21 @@
+#! /bin/bash
+
+set -e
+
+# Both engines return the same features as the baseline results.
+for engine in batch legacy; do
+    peakScout peak2gene \
+        --peak_file test/test_MACS2.bed \
+        --peak_type MACS2 \
+        --species_genome mm39 \
+        --k 3 \
+        --engine $engine \
+        --ref_dir test/test-reference/test \
+        --output_name test_peak2gene_MACS2_$engine \
+        --o test/results/ \
+        --output_type csv
+
+    python3 test/compare_csv.py \
+        --a test/results/test_peak2gene_MACS2_$engine.csv \
+        --e test/test_peak2gene_MACS2_expected_results.csv
+done
@@ -0,0 +1,32 @@
+#! /bin/bash
+
+# The test peaks are far fewer than MIN_WORKER_PEAKS, so it is lifted to run
+# them on the worker processes.
+PEAKSCOUT_MIN_WORKER_PEAKS=0 peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --workers 2 \
+    --ref_dir test/test-reference/test \
+    --output_name test_peak2gene_MACS2_workers \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_peak2gene_MACS2_workers.csv \
+    --e test/test_peak2gene_MACS2_expected_results.csv
+
+# Fewer peaks than MIN_WORKER_PEAKS per worker are run in this process.
+python3 - <<END
+import os
+import sys
+
+sys.path.insert(0, "src")
+import process_features
+
+tasks = {"chr1": (), "chr2": ()}
+sizes = {"chr1": 2, "chr2": 1}
+pids = process_features.iter_chromosomes(os.getpid, tasks, sizes, workers=2)
+assert [pid for _, pid in pids] == [os.getpid()] * 2
+END
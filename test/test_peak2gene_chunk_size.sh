@@ -0,0 +1,29 @@
+#! /bin/bash
+
+set -e
+
+# Chunked output keeps the chromosome order of the input for any chunk size,
+# also with the worker processes kept across chunks (used for any number of
+# peaks with PEAKSCOUT_MIN_WORKER_PEAKS=0).
+for chunk_size in 3 1000; do
+    for workers in 1 2; do
+        output_name=test_peak2gene_chunk_size_${chunk_size}_$workers
+
+        PEAKSCOUT_MIN_WORKER_PEAKS=0 peakScout peak2gene \
+            --peak_file test/test_MACS2_chr2_first.bed \
+            --peak_type MACS2 \
+            --species_genome mm39 \
+            --k 3 \
+            --chunk_size $chunk_size \
+            --workers $workers \
+            --ref_dir test/test-reference/test \
+            --output_name $output_name \
+            --o test/results/ \
+            --output_type csv
+
+        python3 test/compare_csv.py \
+            --a test/results/$output_name.csv \
+            --e test/test_peak2gene_chunk_size_expected_results.csv \
+            --ordered
+    done
+done
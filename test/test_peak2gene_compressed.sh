@@ -0,0 +1,44 @@
+#! /bin/bash
+
+set -e
+
+# Compressed peak files, read whole or in chunks, return the same features as
+# the uncompressed file.
+for peak_file in test/test_MACS2.bed.gz test/test_MACS2.bed.zst; do
+    for chunk_size in 0 3; do
+        output_name=test_peak2gene_compressed_${peak_file##*.}_$chunk_size
+        chunk_args=""
+        if [ $chunk_size -gt 0 ]; then
+            chunk_args="--chunk_size $chunk_size"
+        fi
+
+        peakScout peak2gene \
+            --peak_file $peak_file \
+            --peak_type MACS2 \
+            --species_genome mm39 \
+            --k 3 \
+            $chunk_args \
+            --ref_dir test/test-reference/test \
+            --output_name $output_name \
+            --o test/results/ \
+            --output_type csv
+
+        python3 test/compare_csv.py \
+            --a test/results/$output_name.csv \
+            --e test/test_peak2gene_MACS2_expected_results.csv
+    done
+done
+
+peakScout gene2peak \
+    --gene_file test/test_genes.txt \
+    --peak_file test/test_MACS2.bed.gz \
+    --peak_type MACS2 \
+    --k 3 \
+    --ref_dir test/test-reference/test \
+    --output_name test_gene2peak_compressed \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_gene2peak_compressed.csv \
+    --e test/test_gene2peak_MACS2_expected_results.csv
@@ -0,0 +1,17 @@
+#! /bin/bash
+
+# Every feature of the wide MACS2 expected results, one row per rank.
+peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --layout long \
+    --ref_dir test/test-reference/test \
+    --output_name test_peak2gene_layout_long \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_peak2gene_layout_long.csv \
+    --e test/test_peak2gene_layout_long_expected_results.csv
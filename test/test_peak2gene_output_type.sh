@@ -0,0 +1,20 @@
+#! /bin/bash
+
+set -e
+
+# Every output type holds the same rows as the csv output.
+for output_type in csv.gz csv.zst parquet arrow; do
+    peakScout peak2gene \
+        --peak_file test/test_MACS2.bed \
+        --peak_type MACS2 \
+        --species_genome mm39 \
+        --k 3 \
+        --ref_dir test/test-reference/test \
+        --output_name test_peak2gene_output_type \
+        --o test/results/ \
+        --output_type $output_type
+
+    python3 test/compare_csv.py \
+        --a test/results/test_peak2gene_output_type.$output_type \
+        --e test/test_peak2gene_MACS2_expected_results.csv
+done
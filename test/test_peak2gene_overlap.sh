@@ -0,0 +1,16 @@
+#! /bin/bash
+
+peakScout peak2gene \
+    --peak_file test/test_overlap.bed \
+    --peak_type BED6 \
+    --species_genome mm39 \
+    --k 3 \
+    --down_bound 5000 \
+    --ref_dir test/test-reference/test \
+    --output_name test_peak2gene_overlap \
+    --o test/results/ \
+    --output_type csv
+
+python3 test/compare_csv.py \
+    --a test/results/test_peak2gene_overlap.csv \
+    --e test/test_peak2gene_overlap_expected_results.csv
@@ -0,0 +1,22 @@
+#! /bin/bash
+
+set -e
+
+# The second replicate holds peaks 1-5 of the first, trimmed, and one peak of
+# its own, so only the consensus peaks of peaks 1-5 have the support of both.
+for min_support in 1 2; do
+    peakScout peak2gene \
+        --replicates test/test_MACS2.bed test/test_MACS2_replicate.bed \
+        --min_support $min_support \
+        --peak_type MACS2 \
+        --species_genome mm39 \
+        --k 3 \
+        --ref_dir test/test-reference/test \
+        --output_name test_peak2gene_replicates_min_support_$min_support \
+        --o test/results/ \
+        --output_type csv
+
+    python3 test/compare_csv.py \
+        --a test/results/test_peak2gene_replicates_min_support_$min_support.csv \
+        --e test/test_peak2gene_replicates_min_support_${min_support}_expected_results.csv
+done
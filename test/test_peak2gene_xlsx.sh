@@ -0,0 +1,40 @@
+#! /bin/bash
+
+set -e
+
+peakScout peak2gene \
+    --peak_file test/test_MACS2.bed \
+    --peak_type MACS2 \
+    --species_genome mm39 \
+    --k 3 \
+    --ref_dir test/test-reference/test \
+    --output_name test_peak2gene_xlsx \
+    --o test/results/ \
+    --output_type xlsx
+
+python3 test/compare_xlsx.py \
+    --a test/results/test_peak2gene_xlsx.xlsx \
+    --e test/test_peak2gene_MACS2_expected_results.csv \
+    --sheets Sheet1
+
+# With room for 3 rows per sheet, the 5 peaks of each chromosome are split
+# into two sheets of that chromosome.
+python3 - <<END
+import sys
+
+sys.path.insert(0, "src")
+import polars as pl
+import write_output
+
+write_output.EXCEL_MAX_ROWS = 4
+write_output.write_to_excel(
+    pl.read_csv("test/test_peak2gene_MACS2_expected_results.csv"),
+    "test_peak2gene_xlsx_split",
+    "test/results/",
+)
+END
+
+python3 test/compare_xlsx.py \
+    --a test/results/test_peak2gene_xlsx_split.xlsx \
+    --e test/test_peak2gene_MACS2_expected_results.csv \
+    --sheets 1 1_2 2 2_2
@@ -0,0 +1,45 @@
+#! /bin/bash
+
+set -e
+
+# Binary references return the same features as the csv test reference. The
+# parquet reference is decomposed from the gzip compressed copy of the GTF.
+for ref_format in arrow parquet; do
+    gtf_ref=test/test-reference/test/test.gtf
+    if [ $ref_format = parquet ]; then
+        gtf_ref=$gtf_ref.gz
+    fi
+
+    peakScout decompose \
+        --ref_dir test/results/test-reference-$ref_format \
+        --gtf_ref $gtf_ref \
+        --ref_format $ref_format
+
+    peakScout peak2gene \
+        --peak_file test/test_MACS2.bed \
+        --peak_type MACS2 \
+        --species_genome mm39 \
+        --k 3 \
+        --ref_dir test/results/test-reference-$ref_format \
+        --output_name test_peak2gene_ref_format_$ref_format \
+        --o test/results/ \
+        --output_type csv
+
+    python3 test/compare_csv.py \
+        --a test/results/test_peak2gene_ref_format_$ref_format.csv \
+        --e test/test_peak2gene_MACS2_expected_results.csv
+
+    peakScout gene2peak \
+        --gene_file test/test_genes.txt \
+        --peak_file test/test_MACS2.bed \
+        --peak_type MACS2 \
+        --k 3 \
+        --ref_dir test/results/test-reference-$ref_format \
+        --output_name test_gene2peak_ref_format_$ref_format \
+        --o test/results/ \
+        --output_type csv
+
+    python3 test/compare_csv.py \
+        --a test/results/test_gene2peak_ref_format_$ref_format.csv \
+        --e test/test_gene2peak_MACS2_expected_results.csv
+done
@@ -0,0 +1,66 @@
+#! /bin/bash
+
+set -e
+
+mkdir -p test/results/test-reference-cache
+cp -r test/test-reference/test/gene test/results/test-reference-cache/
+
+# A cached reference is reused until its file changes, and the least recently
+# used references are evicted to stay within the memory cap.
+python3 - <<END
+import os
+import sys
+
+sys.path.insert(0, "src")
+import reference
+
+ref_dir = "test/results/test-reference-cache"
+
+chr1 = reference.load_reference(ref_dir, "gene", "chr1")
+assert reference.load_reference(ref_dir, "gene", "chr1") is chr1
+stats = reference.reference_cache_stats()
+assert (stats["hits"], stats["misses"], stats["stale"]) == (1, 1, 0), stats
+
+path = reference.find_reference(ref_dir, "gene", "chr1", "start")
+stat = os.stat(path)
+os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+assert reference.load_reference(ref_dir, "gene", "chr1") is not chr1
+stats = reference.reference_cache_stats()
+assert (stats["hits"], stats["misses"], stats["stale"]) == (1, 2, 1), stats
+
+chr1 = reference.load_reference(ref_dir, "gene", "chr1")
+chr2 = reference.load_reference(ref_dir, "gene", "chr2")
+chr1 = reference.load_reference(ref_dir, "gene", "chr1")
+# Only one of them fits: chr2, used least recently, is evicted.
+reference.set_reference_cache_limit(max(chr1.estimated_size(), chr2.estimated_size()))
+assert reference.load_reference(ref_dir, "gene", "chr1") is chr1
+assert reference.load_reference(ref_dir, "gene", "chr2") is not chr2
+stats = reference.reference_cache_stats()
+assert (stats["evictions"], stats["entries"]) == (2, 1), stats
+
+reference.clear_reference_cache()
+stats = reference.reference_cache_stats()
+assert (stats["hits"], stats["misses"], stats["entries"]) == (0, 0, 0), stats
+
+# The interval index is cached next to the reference it is built from.
+index = reference.load_interval_index(ref_dir, "gene", "chr1")
+assert reference.load_interval_index(ref_dir, "gene", "chr1") is index
+chr1 = reference.load_reference(ref_dir, "gene", "chr1")
+assert (index[0] == chr1.get_column("start").to_numpy()).all()
+assert (index[2] >= index[1]).all()
+END
+
+# A cap of 0 MB disables caching.
+PEAKSCOUT_REFERENCE_CACHE_MB=0 python3 - <<END
+import sys
+
+sys.path.insert(0, "src")
+import reference
+
+ref_dir = "test/results/test-reference-cache"
+
+chr1 = reference.load_reference(ref_dir, "gene", "chr1")
+assert reference.load_reference(ref_dir, "gene", "chr1") is not chr1
+stats = reference.reference_cache_stats()
+assert (stats["hits"], stats["entries"], stats["max_bytes"]) == (0, 0, 0), stats
+END